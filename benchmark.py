@@ -0,0 +1,351 @@
+'''Benchmark the read throughput of the stream against a Postgres database.
+
+Synthetic tables are created (and filled) for every scenario when they don't
+exist, and every scenario is read end to end for every combination of batch
+size and extraction mode, each in a process of its own so that its peak
+memory can be measured. The results (rows/sec, MB/sec, batch latency
+percentiles and peak RSS) are printed as a table, and written as JSON with
+--output so that they can be compared across versions with --compare.
+
+Usage:
+    PGADDR=localhost:5432/postgres PGUSER=postgres PGPASSWORD= \
+        python benchmark.py [--rows N] [--scenario NAME ...]
+            [--batch-size N ...] [--mode cursor|copy ...]
+            [--options JSON] [--output FILE] [--compare FILE]
+'''
+import os
+import sys
+import json
+import Queue
+import time
+import platform
+import resource
+import argparse
+import traceback
+import subprocess
+import multiprocessing
+from postgres.source import Postgres, connect, EXTRACT_CURSOR, EXTRACT_COPY
+from postgres.pool import WAIT_TIMEOUT
+
+SCHEMA = 'panoply_benchmark'
+ROWS = 100000
+BATCH_SIZE = 5000
+HUGE_FACTOR = 10  # the huge table has this many times the rows
+SMALL_TABLES = 200
+SMALL_ROWS = 100
+WIDE_COLUMNS = 50
+PERCENTILES = (50, 90, 99)
+
+OPTIONS = {
+    'logger': lambda *msgs: None
+}
+
+# the values of the columns of the wide table, by type
+WIDE_TYPES = [
+    ('bigint', 'g'),
+    ('text', 'md5(g::text)'),
+    ('numeric(12, 2)', 'g / 100.0'),
+    ('timestamptz', "now() - g * interval '1s'"),
+    ('boolean', 'g % 2 = 0'),
+]
+
+
+def get_scenarios(rows):
+    '''return the scenarios, each with the tables it reads. Every table is
+    a (name, columns, values, rows) tuple'''
+    wide = [WIDE_TYPES[i % len(WIDE_TYPES)] for i in range(WIDE_COLUMNS)]
+    return {
+        'narrow': [
+            ('narrow', 'id bigint PRIMARY KEY, value int', 'g, g % 1000', rows)
+        ],
+        'wide': [(
+            'wide',
+            ', '.join('c{} {}'.format(i, typ)
+                      for i, (typ, _) in enumerate(wide)),
+            ', '.join(value for _, value in wide),
+            rows
+        )],
+        'jsonb': [(
+            'jsonb',
+            'id bigint PRIMARY KEY, doc jsonb',
+            '''g, (
+                SELECT jsonb_object_agg('key' || i, jsonb_build_object(
+                    'n', g * i, 'name', md5((g * i)::text), 'ok', i % 2 = 0
+                ))
+                FROM generate_series(1, 10) i
+            )''',
+            rows
+        )],
+        'bytea': [(
+            'bytea',
+            'id bigint PRIMARY KEY, data bytea',
+            "g, decode(repeat(md5(g::text), 64), 'hex')",
+            rows
+        )],
+        'many_small': [
+            ('small_{}'.format(i), 'id bigint PRIMARY KEY, name text',
+             'g, md5(g::text)', SMALL_ROWS)
+            for i in range(SMALL_TABLES)
+        ],
+        'huge': [(
+            'huge',
+            'id bigint PRIMARY KEY, name text, amount numeric(12, 2), '
+            'created timestamptz, active boolean',
+            "g, md5(g::text), g / 100.0, now() - g * interval '1s', "
+            "g % 2 = 0",
+            rows * HUGE_FACTOR
+        )],
+    }
+
+
+def get_source(tables=(), **kwargs):
+    source = {
+        'addr': os.environ.get('PGADDR', 'localhost/postgres'),
+        'user': os.environ.get('PGUSER', 'postgres'),
+        'password': os.environ.get('PGPASSWORD', ''),
+        'tables': [{'value': '{}.{}'.format(SCHEMA, t[0])} for t in tables],
+    }
+    source.update(kwargs)
+    return source
+
+
+def create_tables(tables):
+    '''create and fill the tables that don't exist (or have a different
+    number of rows), returns their total size in bytes'''
+    stream = Postgres(get_source(), OPTIONS)
+    stream.conn, stream.cursor = connect(stream.source)
+    stream.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(SCHEMA))
+    size = 0
+    for name, columns, values, rows in tables:
+        table = '{}.{}'.format(SCHEMA, name)
+        stream.execute('SELECT to_regclass(%s) AS oid', (table,))
+        if stream.cursor.fetchone()['oid']:
+            stream.execute('SELECT count(*) AS count FROM {}'.format(table))
+            if stream.cursor.fetchone()['count'] != rows:
+                stream.execute('DROP TABLE {}'.format(table))
+
+        stream.execute('SELECT to_regclass(%s) AS oid', (table,))
+        if not stream.cursor.fetchone()['oid']:
+            stream.execute('CREATE TABLE {} ({})'.format(table, columns))
+            stream.execute(
+                'INSERT INTO {} SELECT {} FROM generate_series(1, %s) g'
+                .format(table, values.replace('%', '%%')), (rows,))
+            stream.execute('ANALYZE {}'.format(table))
+            stream.conn.commit()
+
+        stream.execute('SELECT pg_table_size(%s) AS size', (table,))
+        size += stream.cursor.fetchone()['size']
+
+    stream.conn.commit()
+    stream.close()
+    return size
+
+
+def run(tables, batch_size, mode, options):
+    '''read all of the tables, returns the number of rows read, the elapsed
+    time in seconds and the latency (seconds) of every batch'''
+    source = get_source(tables, __batchSize=batch_size, __extractMode=mode)
+    source.update(options)
+    stream = Postgres(source, OPTIONS)
+
+    rows = 0
+    latencies = []
+    start = time.time()
+    while True:
+        batch_start = time.time()
+        batch = stream.read()
+        if batch is None:
+            break
+
+        latencies.append(time.time() - batch_start)
+        rows += len(batch)
+
+    return rows, time.time() - start, latencies
+
+
+def measure(tables, batch_size, mode, options, results):
+    '''run the benchmark in a process of its own, and add the peak RSS'''
+    try:
+        rows, elapsed, latencies = run(tables, batch_size, mode, options)
+    except Exception:
+        results.put(traceback.format_exc())
+        return
+
+    # ru_maxrss is in kilobytes on linux, and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        rss *= 1024
+
+    results.put((rows, elapsed, latencies, rss))
+
+
+def percentile(values, p):
+    '''return the p-th percentile of the values (nearest rank)'''
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(p / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+def wait(proc, results):
+    '''return the result of the benchmark process, or None when it exited
+    without one (it was killed, ran out of memory, etc.)'''
+    while True:
+        try:
+            return results.get(timeout=WAIT_TIMEOUT)
+        except Queue.Empty:
+            if proc.is_alive():
+                continue
+
+        # the result may have been sent right before the process exited
+        try:
+            return results.get(timeout=WAIT_TIMEOUT)
+        except Queue.Empty:
+            return None
+
+
+def benchmark(scenario, tables, size, batch_size, mode, options):
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(
+        target=measure, args=(tables, batch_size, mode, options, results))
+    proc.start()
+    measured = wait(proc, results)
+    proc.join()
+    if measured is None:
+        raise RuntimeError('{} failed: the benchmark process exited with '
+                           'code {}'.format(scenario, proc.exitcode))
+    if isinstance(measured, basestring):
+        raise RuntimeError('{} failed:\n{}'.format(scenario, measured))
+
+    rows, elapsed, latencies, rss = measured
+
+    result = {
+        'scenario': scenario,
+        'batch_size': batch_size,
+        'mode': mode,
+        'tables': len(tables),
+        'rows': rows,
+        'bytes': size,
+        'seconds': round(elapsed, 3),
+        'rows_per_sec': round(rows / elapsed, 1),
+        'mb_per_sec': round(size / 1e6 / elapsed, 3),
+        'batches': len(latencies),
+        'peak_rss_mb': round(rss / 1e6, 1),
+    }
+    for p in PERCENTILES:
+        latency = percentile(latencies, p)
+        result['latency_p{}_ms'.format(p)] = round(latency * 1000, 2) \
+            if latency is not None else None
+    result['latency_max_ms'] = round(max(latencies) * 1000, 2) \
+        if latencies else None
+    return result
+
+
+def get_version():
+    '''return the commit of the benchmarked code, if known'''
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_server_version():
+    stream = Postgres(get_source(), OPTIONS)
+    stream.conn, stream.cursor = connect(stream.source)
+    stream.execute('SHOW server_version')
+    version = stream.cursor.fetchone()['server_version']
+    stream.close()
+    return version
+
+
+def print_results(results, baseline=None):
+    header = '{:<12} {:>6} {:<6} {:>10} {:>8} {:>11} {:>8} {:>8} {:>8} ' \
+             '{:>8} {:>9}'
+    row = '{:<12} {:>6} {:<6} {:>10} {:>8.2f} {:>11.0f} {:>8.2f} {:>8} ' \
+          '{:>8} {:>8} {:>9.1f}'
+    print header.format('scenario', 'batch', 'mode', 'rows', 'seconds',
+                        'rows/sec', 'MB/sec', 'p50 ms', 'p90 ms', 'p99 ms',
+                        'RSS MB'),
+    print ' {:>8}'.format('change') if baseline else ''
+
+    for r in results:
+        print row.format(r['scenario'], r['batch_size'], r['mode'],
+                         r['rows'], r['seconds'], r['rows_per_sec'],
+                         r['mb_per_sec'], r['latency_p50_ms'],
+                         r['latency_p90_ms'], r['latency_p99_ms'],
+                         r['peak_rss_mb']),
+
+        # the change of rows/sec from the same run of the baseline
+        base = (baseline or {}).get(
+            (r['scenario'], r['batch_size'], r['mode']))
+        if base:
+            change = r['rows_per_sec'] / base['rows_per_sec'] - 1
+            print ' {:>+7.1f}%'.format(change * 100)
+        else:
+            print ''
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the read throughput of the stream')
+    parser.add_argument('--rows', type=int, default=ROWS,
+                        help='rows per table (default: %(default)s)')
+    parser.add_argument('--scenario', action='append',
+                        help='scenarios to run (default: all)')
+    parser.add_argument('--batch-size', action='append', type=int,
+                        help='batch sizes (default: {})'.format(BATCH_SIZE))
+    parser.add_argument('--mode', action='append',
+                        choices=(EXTRACT_CURSOR, EXTRACT_COPY),
+                        help='extraction modes (default: cursor)')
+    parser.add_argument('--options', type=json.loads, default={},
+                        help='more source options, as JSON')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--compare',
+                        help='compare to the results of a previous --output')
+    args = parser.parse_args()
+
+    scenarios = get_scenarios(args.rows)
+    names = args.scenario or sorted(scenarios)
+    for name in names:
+        if name not in scenarios:
+            parser.error('unknown scenario: {} (choose from {})'.format(
+                name, ', '.join(sorted(scenarios))))
+
+    results = []
+    for name in names:
+        tables = scenarios[name]
+        size = create_tables(tables)
+        for batch_size in args.batch_size or [BATCH_SIZE]:
+            for mode in args.mode or [EXTRACT_CURSOR]:
+                results.append(benchmark(name, tables, size, batch_size,
+                                         mode, args.options))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = dict(
+                ((r['scenario'], r['batch_size'], r['mode']), r)
+                for r in json.load(f)['results']
+            )
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'version': get_version(),
+                'python': platform.python_version(),
+                'postgres': get_server_version(),
+                'rows': args.rows,
+                'options': args.options,
+                'results': results
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
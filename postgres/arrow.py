@@ -0,0 +1,113 @@
+import panoply
+import psycopg2.extensions
+from decoding import raw
+
+try:
+    import pyarrow
+except ImportError:  # only required for the `arrow` row format
+    pyarrow = None
+
+BYTEA = 17
+NUMERIC = 1700
+TIMESTAMP = 1114
+TIMESTAMPTZ = 1184
+
+# decimal128 holds up to 38 digits, wider (and unconstrained) numerics are
+# read as their text
+MAX_PRECISION = 38
+
+# The arrow types of the Postgres types, by oid. Values of the other types
+# (text, json, uuid, arrays, etc.) are read as their text
+TYPES = {
+    16: 'bool_',
+    BYTEA: 'binary',
+    20: 'int64',
+    21: 'int16',
+    23: 'int32',
+    26: 'int64',  # oid, unsigned
+    700: 'float32',
+    701: 'float64',
+    1082: 'date32',
+}
+
+
+class RecordBatchBuilder(object):
+    '''build arrow record batches out of rows (tuples) with the same columns.
+
+    The schema is derived once from the description of the columns, and the
+    rows are built into arrays column by column. Values that are read as text
+    are registered to be kept as the text sent by the server rather than
+    converted into Python objects'''
+
+    def __init__(self, description, text_types=()):
+        if pyarrow is None:
+            raise panoply.PanoplyException(
+                'The arrow row format requires pyarrow',
+                retryable=False
+            )
+
+        fields = []
+        self.converts = []
+        self.text_types = set()
+        for col in description:
+            name, oid, precision, scale = col[0], col[1], col[4], col[5]
+            typ = None
+            if oid not in text_types:
+                typ = get_type(oid, precision, scale)
+
+            convert = None
+            if typ is None:
+                typ = pyarrow.string()
+                if oid == NUMERIC:
+                    convert = str  # decimals that don't fit decimal128
+                else:
+                    self.text_types.add(oid)
+            elif oid == BYTEA:
+                convert = str  # psycopg2 returns buffers
+
+            fields.append(pyarrow.field(name, typ))
+            self.converts.append(convert)
+
+        self.schema = pyarrow.schema(fields)
+
+    def register(self, conn):
+        '''keep the values of the types that are read as text as the text
+        sent by the server'''
+        if self.text_types:
+            typ = psycopg2.extensions.new_type(tuple(self.text_types),
+                                               'ARROW_TEXT', raw)
+            psycopg2.extensions.register_type(typ, conn)
+
+    def build(self, rows, metadata):
+        '''return a record batch of the rows, with the metadata (internals) in
+        its schema'''
+        columns = zip(*rows) if rows else [()] * len(self.converts)
+        arrays = []
+        for i, values in enumerate(columns):
+            convert = self.converts[i]
+            if convert:
+                values = [v if v is None else convert(v) for v in values]
+            arrays.append(pyarrow.array(values, type=self.schema[i].type))
+
+        return pyarrow.RecordBatch.from_arrays(
+            arrays,
+            schema=self.schema.with_metadata(metadata)
+        )
+
+
+def get_type(oid, precision=None, scale=None):
+    '''return the arrow type of a Postgres type, or None when it's read as
+    text'''
+    if oid == NUMERIC:
+        if precision and precision <= MAX_PRECISION:
+            return pyarrow.decimal128(precision, scale or 0)
+        return None
+
+    # timestamps with time zones are read in UTC, see `connect`
+    if oid == TIMESTAMP:
+        return pyarrow.timestamp('us')
+    if oid == TIMESTAMPTZ:
+        return pyarrow.timestamp('us', tz='UTC')
+
+    name = TYPES.get(oid)
+    return getattr(pyarrow, name)() if name else None
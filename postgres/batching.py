@@ -0,0 +1,146 @@
+import sys
+import threading
+from pool import WAIT_TIMEOUT
+
+MIN_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 100000
+
+# The number of rows measured to estimate the size of a batch
+SAMPLE_SIZE = 100
+
+# The overhead (bytes) of Python objects over the width of the values in the
+# database, used to estimate the size of a row before any row is measured
+ROW_OVERHEAD = 300
+VALUE_OVERHEAD = 60
+
+# A batch can at most double in size from one fetch to the next, so that a
+# single small measurement doesn't cause a huge fetch
+MAX_GROWTH = 2
+
+
+class BatchSizer(object):
+    '''adjust the number of rows fetched per batch to hit a target size (in
+    bytes) and/or a target latency (in seconds) per batch.
+
+    The first batch of a table is sized by the average width of its rows
+    when it's known, and the following batches by the size and latency
+    measured for the previous ones'''
+
+    def __init__(self, size, target_bytes=None, target_latency=None,
+                 min_size=MIN_BATCH_SIZE, max_size=MAX_BATCH_SIZE):
+        self.initial = size
+        self.target_bytes = target_bytes
+        self.target_latency = target_latency
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = self.clamp(size)
+
+    def start(self, row_size=None):
+        '''reset the batch size for a new table, with the estimated size of
+        its rows in bytes, if known'''
+        size = self.initial
+        if self.target_bytes and row_size:
+            size = self.target_bytes // row_size
+
+        self.size = self.clamp(size)
+        return self.size
+
+    def update(self, rows, size, seconds):
+        '''update the batch size with the measurements of the last batch: the
+        number of rows, their size in bytes and the time it took to fetch'''
+        if not rows:
+            return self.size
+
+        sizes = []
+        if self.target_bytes and size:
+            sizes.append(self.target_bytes * rows // size)
+        if self.target_latency and seconds > 0:
+            sizes.append(int(self.target_latency * rows / seconds))
+
+        if sizes:
+            self.size = self.clamp(min(min(sizes), self.size * MAX_GROWTH))
+        return self.size
+
+    def clamp(self, size):
+        return max(self.min_size, min(self.max_size, size))
+
+
+class MemoryBudget(object):
+    '''a budget of memory (in bytes) shared by all of the batches that are
+    held at once: fetched by the workers, waiting to be consumed, or returned
+    and not released yet.
+
+    A batch reserves its estimated size before it's fetched, and the
+    reservation is replaced by its measured size once it was fetched. The
+    reservations block while the budget is used up, until earlier batches
+    are released by the consumer, unless nothing is held at all so that a
+    single batch larger than the budget can still be read'''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def acquire(self, size):
+        '''reserve `size` bytes, waiting until they fit in the budget. Returns
+        immediately once the budget is closed'''
+        with self.cond:
+            while self.used and self.used + size > self.limit:
+                if self.closed:
+                    return
+                self.cond.wait(WAIT_TIMEOUT)
+            self.used += size
+
+    def adjust(self, reserved, size):
+        '''replace a reservation with the measured size of the batch. It
+        doesn't block even when the batch turned out larger than reserved, the
+        following reservations wait instead'''
+        with self.cond:
+            self.used = max(0, self.used + size - reserved)
+            self.cond.notify_all()
+
+    def release(self, size):
+        self.adjust(size, 0)
+
+    def close(self):
+        '''wake up (and stop blocking) all of the pending reservations'''
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+def estimate_row_size(width, columns):
+    '''estimate the size (in bytes) of a row in memory from the average width
+    of the row in the database and its number of columns'''
+    return ROW_OVERHEAD + width + columns * VALUE_OVERHEAD
+
+
+def estimate_size(rows, sample=SAMPLE_SIZE):
+    '''estimate the size (in bytes) of a list of rows in memory by measuring
+    a sample of the rows'''
+    if not rows:
+        return 0
+
+    step = max(1, len(rows) // sample)
+    sampled = rows[::step]
+    size = sum(get_row_size(row) for row in sampled)
+    return size * len(rows) // len(sampled)
+
+
+def get_row_size(row):
+    '''return the size of a row (dict or tuple) and its values in bytes. The
+    keys of dict rows are not included, they're shared between the rows'''
+    values = row.itervalues() if isinstance(row, dict) else row
+    return sys.getsizeof(row) + sum(get_size(v) for v in values)
+
+
+def get_size(value):
+    '''return the size of a value in bytes, including nested values (json)'''
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            get_size(k) + get_size(v) for k, v in value.iteritems()
+        )
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(get_size(v) for v in value)
+    return sys.getsizeof(value)
@@ -0,0 +1,106 @@
+import os
+import json
+import errno
+import hashlib
+import tempfile
+
+# A marker of the state of the catalog. DDL writes new rows to the catalogs
+# of the cached entries, which changes their xmins (or their count): tables
+# and schemas (pg_class, pg_namespace), columns, including renaming them or
+# changing their nullability (pg_attribute), keys (pg_index) and partitions
+# (pg_inherits)
+MARKER_QUERY = '''
+    SELECT count(*) || '/' || sum(xmin::text::bigint) AS marker
+    FROM (
+        SELECT xmin FROM pg_class
+        UNION ALL
+        SELECT xmin FROM pg_namespace
+        UNION ALL
+        SELECT xmin FROM pg_attribute
+        UNION ALL
+        SELECT xmin FROM pg_index
+        UNION ALL
+        SELECT xmin FROM pg_inherits
+    ) c
+'''
+
+
+class CatalogCache(object):
+    '''the results of catalog queries (the list of tables, their columns and
+    keys), cached on disk in a file per database and user.
+
+    The cache is only valid for the marker of the catalog it was saved with,
+    it's discarded once the catalog changed. Entries are kept by kind and
+    name, and must be JSON serializable'''
+
+    def __init__(self, directory, source):
+        key = '{}@{}'.format(source['user'], source['addr'])
+        self.path = os.path.join(
+            directory,
+            'catalog-{}.json'.format(hashlib.md5(key).hexdigest())
+        )
+        self.marker = None
+        self.entries = {}
+        self.discarded = set()
+        self.changed = False
+
+    def load(self, marker):
+        '''load the cache, unless it was saved with a different marker'''
+        self.marker = marker
+        data = self._read()
+        if data.get('marker') == marker:
+            self.entries = data.get('entries', {})
+        return self
+
+    def get(self, kind, name):
+        return self.entries.get(kind, {}).get(name)
+
+    def set(self, kind, name, value):
+        self.entries.setdefault(kind, {})[name] = value
+        self.changed = True
+
+    def discard(self, name):
+        '''drop the entries of a name (of every kind), also from the file
+        once it's saved. Used when they turn out to be stale'''
+        for values in self.entries.values():
+            values.pop(name, None)
+        self.discarded.add(name)
+        self.changed = True
+
+    def save(self):
+        '''write the cache, along with the entries that were saved by other
+        streams (workers) in the meantime for the same marker'''
+        if not self.changed:
+            return
+
+        data = self._read()
+        entries = {}
+        if data.get('marker') == self.marker:
+            entries = data.get('entries', {})
+        for values in entries.values():
+            for name in self.discarded:
+                values.pop(name, None)
+        for kind, values in self.entries.items():
+            entries.setdefault(kind, {}).update(values)
+
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # written to a temporary file that replaces the cache, so that it's
+        # never read half written
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'marker': self.marker, 'entries': entries}, f)
+        os.rename(tmp, self.path)
+        self.changed = False
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}  # missing, or corrupt
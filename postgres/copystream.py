@@ -0,0 +1,177 @@
+import re
+import sys
+import Queue
+import threading
+import psycopg2.extensions
+from pool import WAIT_TIMEOUT
+
+# Size of the chunks of COPY data handed over from the COPY thread. Postgres
+# sends a message per row, so they're buffered to reduce the queue overhead
+CHUNK_SIZE = 64 * 1024  # bytes
+QUEUE_SIZE = 16  # chunks
+
+NULL = '\\N'
+ESCAPES = {
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+    'v': '\v',
+}
+ESCAPE_RE = re.compile(r'\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)')
+OCTAL = '01234567'
+
+# marks the end of the COPY data
+END = object()
+
+
+class CopyReader(object):
+    '''read the results of a query with `COPY (query) TO STDOUT`.
+
+    COPY streams the whole result in one go, which is much faster than
+    fetching it from a cursor batch by batch. It runs in a background thread
+    and the stream is parsed into rows as they're read. The thread is blocked
+    while enough data is waiting to be read, so memory stays bounded'''
+
+    def __init__(self, conn, cursor, query, params=None, tuples=False):
+        self.conn = conn
+        self.cursor = cursor
+        self.tuples = tuples
+
+        # the columns and their types are described by running the query
+        # without fetching any rows, as COPY doesn't describe them
+        self.cursor.execute('SELECT * FROM ({}) q LIMIT 0'.format(query),
+                            params or None)
+        description = self.cursor.description
+        self.columns = [col[0] for col in description]
+        self.casts = [get_typecaster(col[1], conn) for col in description]
+
+        if params:
+            query = self.cursor.mogrify(query, params)
+        self.query = 'COPY ({}) TO STDOUT'.format(query)
+
+        self.chunks = Queue.Queue(maxsize=QUEUE_SIZE)
+        self.stopped = threading.Event()
+        self.buf = []
+        self.size = 0
+        self.pending = ''
+        self.rows = []
+        self.done = False
+        self.thread = threading.Thread(target=self._copy)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def read(self, n):
+        '''return up to n rows, as dicts like the ones read from a cursor (or
+        tuples of values in the order of `columns`). An empty list is
+        returned once all of the rows were read'''
+        while len(self.rows) < n and not self.done:
+            try:
+                chunk = self.chunks.get(timeout=WAIT_TIMEOUT)
+            except Queue.Empty:
+                continue
+
+            if chunk is END:
+                self.done = True
+            elif isinstance(chunk, tuple):
+                self.done = True
+                raise chunk[0], chunk[1], chunk[2]
+            else:
+                self._parse(chunk)
+
+        result, self.rows = self.rows[:n], self.rows[n:]
+        return result
+
+    def close(self):
+        '''stop the COPY if it's still running'''
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.conn.cancel()
+            while self.thread.is_alive():
+                try:
+                    self.chunks.get(timeout=WAIT_TIMEOUT)
+                except Queue.Empty:
+                    pass
+
+    def write(self, data):
+        '''called by psycopg2 with the COPY data'''
+        self.buf.append(data)
+        self.size += len(data)
+        if self.size >= CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self.buf:
+            self._put(''.join(self.buf))
+            self.buf = []
+            self.size = 0
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=WAIT_TIMEOUT)
+                return
+            except Queue.Full:
+                pass
+
+        # abort the COPY, the reader was closed
+        raise psycopg2.extensions.QueryCanceledError('COPY was stopped')
+
+    def _copy(self):
+        try:
+            self.cursor.copy_expert(self.query, self)
+            self._flush()
+            self._put(END)
+        except Exception:
+            if not self.stopped.is_set():
+                self._put(sys.exc_info())
+
+    def _parse(self, chunk):
+        lines = (self.pending + chunk).split('\n')
+
+        # the last line is incomplete (or empty when the chunk ends a line)
+        self.pending = lines.pop()
+
+        columns = self.columns
+        casts = self.casts
+        cursor = self.cursor
+        for line in lines:
+            values = tuple(
+                None if v == NULL else cast(unescape(v), cursor)
+                for v, cast in zip(line.split('\t'), casts)
+            )
+            if not self.tuples:
+                values = dict(zip(columns, values))
+            self.rows.append(values)
+
+
+def get_typecaster(oid, conn=None):
+    '''return the psycopg2 typecaster for a type, so that values are converted
+    the same way they are when they're read from a cursor. Typecasters that
+    were registered on the connection take precedence'''
+    types = getattr(conn, 'string_types', None)
+    if isinstance(types, dict) and oid in types:
+        return types[oid]
+
+    caster = psycopg2.extensions.string_types.get(oid)
+    return caster or (lambda value, cursor: value)
+
+
+def unescape(value):
+    '''unescape a value in the text format of COPY'''
+    if '\\' not in value:
+        return value
+    return ESCAPE_RE.sub(_unescape, value)
+
+
+def _unescape(match):
+    seq = match.group(1)
+    if seq[0] == 'x' and len(seq) > 1:
+        return chr(int(seq[1:], 16))
+    if seq[0] in OCTAL:
+        return chr(int(seq, 8))
+    return ESCAPES.get(seq, seq)
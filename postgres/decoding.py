@@ -0,0 +1,85 @@
+import psycopg2.extensions
+import panoply
+
+# Decoding modes per type: `python` converts the values into Python objects
+# (the default of psycopg2), `raw` keeps them as the text sent by the server
+# and `lazy` keeps the text but can still be converted on demand
+DECODE_PYTHON = 'python'
+DECODE_RAW = 'raw'
+DECODE_LAZY = 'lazy'
+DECODE_MODES = (DECODE_PYTHON, DECODE_RAW, DECODE_LAZY)
+
+# The oids of the configured types, by their names (or aliases, like
+# `timestamptz`). Unknown types are NULL
+TYPES_QUERY = '''
+    SELECT t.name, to_regtype(t.name)::oid AS oid
+    FROM unnest(%s::text[]) AS t(name)
+'''
+
+
+class LazyValue(str):
+    '''the text of a value as it was sent by the server, that can still be
+    converted into the Python object psycopg2 would've returned with
+    `value`. It's a subclass per type (and connection) that holds the
+    original typecaster, so that no memory is added to every value'''
+
+    __slots__ = ()
+    caster = None
+    cursor = None
+
+    @property
+    def value(self):
+        return type(self).caster(str(self), type(self).cursor)
+
+
+def register_decoders(conn, cursor, decode):
+    '''register typecasters on the connection for the types that are not
+    converted into Python objects, `decode` maps type names to their mode'''
+    for name, mode in decode.items():
+        if mode not in DECODE_MODES:
+            raise panoply.PanoplyException(
+                'Unknown decoding mode for {}: {}'.format(name, mode),
+                retryable=False
+            )
+
+    cursor.execute(TYPES_QUERY, (list(decode),))
+    for row in cursor.fetchall():
+        name, oid = row['name'], row['oid']
+        if oid is None:
+            raise panoply.PanoplyException(
+                'Unknown type: {}'.format(name),
+                retryable=False
+            )
+
+        mode = decode[name]
+        if mode == DECODE_RAW:
+            caster = raw
+        elif mode == DECODE_LAZY:
+            caster = get_lazy_caster(conn, name, oid)
+        else:
+            continue
+
+        typ = psycopg2.extensions.new_type((oid,), name.upper(), caster)
+        psycopg2.extensions.register_type(typ, conn)
+
+
+def raw(value, cursor):
+    return value
+
+
+def get_lazy_caster(conn, name, oid):
+    '''return a typecaster that wraps the text of the values with a
+    `LazyValue` that converts them with the original typecaster of the type'''
+    original = psycopg2.extensions.string_types.get(oid)
+    if original is None:
+        return raw  # psycopg2 keeps them as text anyway
+
+    lazy = type('LazyValue', (LazyValue,), {
+        '__slots__': (),
+        'caster': staticmethod(original),
+        'cursor': conn.cursor()
+    })
+
+    def caster(value, cursor):
+        return value if value is None else lazy(value)
+    return caster
@@ -0,0 +1,117 @@
+import time
+import threading
+import psycopg2
+import panoply
+
+PRIMARY = 'primary'
+REPLICA = 'replica'
+ROLES = (PRIMARY, REPLICA)
+
+# Replicas that lag behind the primary by more than this are not read from
+MAX_LAG = 60  # seconds
+
+# How long a host that failed (or lagged) is skipped before it's tried again
+FAILOVER_TIMEOUT = 60  # seconds
+
+# The replication lag of a replica: zero when it replayed everything it
+# received, otherwise the time since the last transaction it replayed was
+# committed. NULL on a primary
+LAG_QUERY = '''
+    SELECT CASE
+        WHEN pg_last_{0}_receive_{1}() = pg_last_{0}_replay_{1}() THEN 0
+        ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+    END AS lag
+'''
+
+# The functions were renamed from xlog/location to wal/lsn in Postgres 10
+WAL_VERSION = 100000
+
+
+class Hosts(object):
+    '''the hosts that the tables are read from: a primary and its replicas.
+
+    The tables are read from the replicas, each stream (worker) from the one
+    with the fewest streams reading from it, and from the primary only when
+    none of the replicas is healthy. A host that fails, or a replica that
+    lags behind by more than `max_lag` seconds, is skipped for a while so
+    that the retry fails over to another one. It's shared by the stream and
+    its workers'''
+
+    def __init__(self, hosts, max_lag=MAX_LAG,
+                 failover_timeout=FAILOVER_TIMEOUT):
+        for host in hosts:
+            if host.get('role', REPLICA) not in ROLES:
+                raise panoply.PanoplyException(
+                    'Unknown role of host {}: {}'.format(host['addr'],
+                                                         host['role']),
+                    retryable=False
+                )
+
+        self.hosts = [dict(h, role=h.get('role', REPLICA)) for h in hosts]
+        self.max_lag = max_lag
+        self.failover_timeout = failover_timeout
+        self.load = dict((h['addr'], 0) for h in self.hosts)
+        self.failed = {}
+        self.lock = threading.Lock()
+
+    @property
+    def primary(self):
+        return next(h for h in self.hosts if h['role'] == PRIMARY)
+
+    def pick(self, exclude=()):
+        '''return the host to connect to, other than the excluded ones, and
+        count the stream on it: the replica with the fewest streams that
+        didn't fail recently, otherwise the primary. The hosts that failed are
+        still picked last, when there's nothing else. None when all of the
+        hosts are excluded'''
+        now = time.time()
+        with self.lock:
+            hosts = [(self.failed.get(h['addr'], 0) > now,
+                      h['role'] == PRIMARY,
+                      self.load[h['addr']],
+                      i, h)
+                     for i, h in enumerate(self.hosts)
+                     if h['addr'] not in exclude]
+            if not hosts:
+                return None
+
+            host = min(hosts)[-1]
+            self.load[host['addr']] += 1
+            return host
+
+    def release(self, addr):
+        with self.lock:
+            self.load[addr] = max(0, self.load[addr] - 1)
+
+    def fail(self, addr):
+        '''skip the host for a while'''
+        with self.lock:
+            self.failed[addr] = time.time() + self.failover_timeout
+
+
+def get_hosts(source):
+    '''return the hosts of the source, the `addr` is the primary unless one
+    of the `__hosts` is'''
+    hosts = list(source.get('__hosts') or [])
+    if not any(h.get('role') == PRIMARY for h in hosts):
+        hosts.insert(0, {'addr': source['addr'], 'role': PRIMARY})
+    return hosts
+
+
+def get_lag(conn, cursor):
+    '''return the replication lag of the host in seconds, 0 on a primary'''
+    names = ('wal', 'lsn')
+    if conn.server_version < WAL_VERSION:
+        names = ('xlog', 'location')
+    cursor.execute(LAG_QUERY.format(*names))
+    lag = cursor.fetchone()['lag']
+    conn.rollback()
+    return float(lag or 0)
+
+
+def is_host_error(e):
+    '''whether the error is caused by the host rather than the query, so
+    that it should be failed over: it's unreachable, the connection was lost,
+    or the query was cancelled by a conflict with the recovery of a replica
+    (which psycopg2 raises as an OperationalError as well)'''
+    return isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
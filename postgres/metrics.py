@@ -0,0 +1,116 @@
+import time
+
+# The phases of reading a batch that are timed
+CONNECT = 'connect'
+DECLARE = 'declare'  # DECLARE the cursor, or start the COPY
+FETCH = 'fetch'  # the server side FETCH (or reading the COPY stream)
+TYPECAST = 'typecast'  # converting the fetched values by psycopg2
+ROWS = 'rows'  # building the rows with the internals
+STATE = 'state'  # reporting the state
+
+
+class Metrics(object):
+    '''collect timing spans and counters (rows, bytes, batches and retries)
+    per table and per batch.
+
+    Every span and counter is passed to the callback as it's measured, and
+    a summary of the table is passed when it's done. Without a callback
+    nothing is measured, spans are a shared no-op'''
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.enabled = callback is not None
+        self.table = None
+        self.batch = 0
+        self.spans = {}
+        self.counters = {}
+
+    def start_table(self, table):
+        self.table = table
+        self.batch = 0
+        self.spans = {}
+        self.counters = {}
+
+    def start_batch(self):
+        self.batch += 1
+
+    def span(self, name):
+        '''return a context manager that times a phase of the current batch'''
+        if not self.enabled:
+            return NOOP
+        return Span(self, name)
+
+    def add_span(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0) + seconds
+        self.callback({
+            'type': 'span',
+            'name': name,
+            'table': self.table,
+            'batch': self.batch,
+            'seconds': seconds
+        })
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + value
+        self.callback({
+            'type': 'counter',
+            'name': name,
+            'table': self.table,
+            'batch': self.batch,
+            'value': value
+        })
+
+    def end_table(self):
+        '''pass the summary of the current table to the callback, and return
+        it (None when disabled)'''
+        if not self.enabled or self.table is None:
+            return None
+
+        summary = {
+            'type': 'summary',
+            'table': self.table,
+            'batches': self.batch,
+            'spans': self.spans,
+            'counters': self.counters
+        }
+        self.callback(summary)
+        self.table = None
+        return summary
+
+
+class Span(object):
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_span(self.name, time.time() - self.start)
+
+
+class NoopSpan(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NOOP = NoopSpan()
+
+
+def format_summary(summary):
+    '''format the summary of a table for the log'''
+    spans = ', '.join('{} {:.3f}s'.format(name, seconds)
+                      for name, seconds in sorted(summary['spans'].items()))
+    counters = summary['counters']
+    counters = ', '.join('{} {}'.format(name, counters[name])
+                         for name in sorted(counters))
+    return 'Table {}: {} batches, {}; {}'.format(
+        summary['table'], summary['batches'], counters, spans)
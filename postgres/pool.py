@@ -0,0 +1,129 @@
+import sys
+import Queue
+import threading
+
+# How long to wait on a queue (or a condition, or a socket) before checking
+# again whether the pool (budget, COPY, etc.) was stopped in the meantime. It
+# also keeps the consumer interruptible, as waiting on a queue without a
+# timeout can't be interrupted. Shared by the other modules that wait
+WAIT_TIMEOUT = 1  # seconds
+
+RESULT = 'result'
+ERROR = 'error'
+DONE = 'done'
+
+
+class Pool(object):
+    '''read tables concurrently, each worker with a stream (and connection) of
+    its own.
+
+    Batches are handed over through a bounded queue along with the state they
+    checkpoint, so that the state is only reported once the batch is returned
+    to the consumer. The workers block when the queue is full, so at most
+    `depth` batches are held in memory on top of the ones being fetched.
+
+    With a memory budget, the workers also block until the batches fit in the
+    budget, see `MemoryBudget`. Every batch is handed over with its size, to
+    be released by the consumer once it's done with the batch'''
+
+    def __init__(self, factory, tables, workers, depth, batch_size,
+                 budget=None):
+        self.factory = factory
+        self.batch_size = batch_size
+        self.budget = budget
+        self.tables = Queue.Queue()
+        for table in tables:
+            self.tables.put(table)
+
+        self.results = Queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.threads = [
+            threading.Thread(target=self._work)
+            for _ in range(min(workers, len(tables)))
+        ]
+        self.running = 0
+
+    def start(self):
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+        self.running = len(self.threads)
+        return self
+
+    def get(self):
+        '''return the next (table, batch, state, size) tuple, or None when all
+        of the tables were read. Errors raised by the workers are re-raised
+        here, after the rest of the workers are stopped'''
+        while self.running:
+            try:
+                kind, value = self.results.get(timeout=WAIT_TIMEOUT)
+            except Queue.Empty:
+                continue
+
+            if kind == DONE:
+                self.running -= 1
+            elif kind == ERROR:
+                self.stop()
+                raise value[0], value[1], value[2]
+            else:
+                return value
+
+        return None
+
+    def stop(self):
+        '''stop all of the workers, discarding the batches that were already
+        fetched but not consumed (their state was never reported)'''
+        self.stopped.set()
+        if self.budget:
+            self.budget.close()
+        self.running = 0
+        while True:
+            try:
+                self.results.get_nowait()
+            except Queue.Empty:
+                break
+
+    def _put(self, kind, value):
+        while not self.stopped.is_set():
+            try:
+                self.results.put((kind, value), timeout=WAIT_TIMEOUT)
+                return
+            except Queue.Full:
+                pass
+
+    def _work(self):
+        stream = None
+
+        # the worker stream reports its state when a batch is read, but it
+        # should only be reported by the consumer once the batch is returned
+        states = []
+
+        try:
+            stream = self.factory()
+            stream.on('source-state', lambda state: states.append(state))
+
+            while not self.stopped.is_set():
+                try:
+                    table = self.tables.get_nowait()
+                except Queue.Empty:
+                    break
+
+                stream.tables = [table]
+                stream.index = 0
+                while not self.stopped.is_set():
+                    batch = stream.read_batch(self.batch_size)
+                    if batch is None:
+                        break
+
+                    state = states.pop() if states else None
+                    self._put(RESULT, (table, batch, state, stream.reserved))
+        except Exception:
+            self._put(ERROR, sys.exc_info())
+        finally:
+            try:
+                if stream:
+                    stream.close()
+            except Exception:
+                pass  # the connection might already be broken
+            self._put(DONE, None)
@@ -0,0 +1,364 @@
+import re
+import time
+import select
+import struct
+from pool import WAIT_TIMEOUT
+from copystream import get_typecaster
+
+# Logical decoding output plugins: `test_decoding` is shipped with Postgres
+# and needs no setup, `pgoutput` (Postgres 10+) is the binary protocol used by
+# the built-in logical replication and requires a publication
+PLUGIN_TEST_DECODING = 'test_decoding'
+PLUGIN_PGOUTPUT = 'pgoutput'
+
+# The stream is considered caught up when no changes arrive for this long
+IDLE_TIMEOUT = 5  # seconds
+
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+TRUNCATE = 'truncate'
+
+TEST_DECODING_OPTIONS = {
+    'include-xids': '0',
+    'skip-empty-xacts': '1'
+}
+
+# table public.foo: INSERT: id[integer]:1 name[text]:'foo'
+CHANGE_RE = re.compile(
+    r'^table (.+?): (INSERT|UPDATE|DELETE|TRUNCATE):(?: (.*))?$',
+    re.DOTALL
+)
+NO_DATA = ('(no-tuple-data)', '(no-flags)')
+UNCHANGED_TOAST = 'unchanged-toast-datum'
+
+
+class ChangeReader(object):
+    '''read the changes decoded from a logical replication slot.
+
+    Every change is returned as a (schema, table, operation, row, lsn) tuple,
+    where the row holds the new values of inserted and updated rows and the
+    key (or old values, depending on the replica identity) of deleted rows.
+    The LSN of the last transaction that was completely read is kept in
+    `lsn`, resuming from it re-reads the transaction that was read in part.
+
+    The slot is only advanced to `flush_lsn`, the LSN that was checkpointed
+    (by a previous run), while the stream starts after `start_lsn`, which
+    might be newer when the read is retried within a run'''
+
+    def __init__(self, conn, cursor, slot, plugin=PLUGIN_TEST_DECODING,
+                 publication=None, start_lsn=None, end_lsn=None, types=None,
+                 tables=None, idle_timeout=IDLE_TIMEOUT, flush_lsn=None):
+        self.conn = conn
+        self.cursor = cursor
+        self.slot = slot
+        self.plugin = plugin
+        self.publication = publication
+        self.lsn = start_lsn
+        self.flush_lsn = flush_lsn
+        self.end_lsn = parse_lsn(end_lsn) if end_lsn else None
+        self.types = types or {}
+        self.tables = set(tables) if tables else None
+        self.idle_timeout = idle_timeout
+        self.relations = {}
+        self.casts = {}
+        self.pending = None
+        self.done = False
+
+    def start(self, create=False):
+        '''start streaming the changes after the start LSN. The slot is
+        advanced to the flush LSN, as everything before it was checkpointed'''
+        if create:
+            self.cursor.create_replication_slot(self.slot,
+                                                output_plugin=self.plugin)
+
+        options = TEST_DECODING_OPTIONS
+        if self.plugin == PLUGIN_PGOUTPUT:
+            options = {
+                'proto_version': '1',
+                'publication_names': self.publication
+            }
+
+        start_lsn = parse_lsn(self.lsn) if self.lsn else 0
+        self.cursor.start_replication(
+            slot_name=self.slot,
+            start_lsn=start_lsn,
+            options=options
+        )
+        if self.flush_lsn:
+            self.cursor.send_feedback(flush_lsn=parse_lsn(self.flush_lsn))
+        return self
+
+    def read(self, n):
+        '''return up to n changes (a truncate of several tables might return
+        a few more). An empty list is returned once the stream caught up'''
+        changes = []
+        last = time.time()
+        while not self.done:
+            if self.pending:
+                msg, parsed = self.pending
+                self.pending = None
+            else:
+                msg = self.cursor.read_message()
+                if msg is None:
+                    if len(changes) >= n:
+                        break
+                    if time.time() - last >= self.idle_timeout:
+                        self.done = True
+                    else:
+                        select.select([self.cursor], [], [], WAIT_TIMEOUT)
+                    continue
+
+                last = time.time()
+                if self.plugin == PLUGIN_PGOUTPUT:
+                    parsed = self.parse_pgoutput(msg.payload)
+                else:
+                    parsed = self.parse_test_decoding(msg.payload)
+
+            if parsed is COMMIT:
+                self.lsn = format_lsn(msg.data_start)
+                if self.end_lsn and msg.data_start >= self.end_lsn:
+                    self.done = True  # caught up with the start of the read
+                continue
+
+            # a full batch still takes the COMMIT that's already waiting, so
+            # that the transaction isn't read again when resuming from here
+            if len(changes) >= n:
+                self.pending = (msg, parsed)
+                break
+
+            lsn = format_lsn(msg.data_start)
+            for schema, table, op, row in parsed:
+                if self.tables is None or schema + '.' + table in self.tables:
+                    changes.append((schema, table, op, row, lsn))
+
+        return changes
+
+    def close(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass  # it's discarded anyway
+
+    def parse_test_decoding(self, payload):
+        '''parse a change in the text format of test_decoding, the values are
+        converted by the typecasters of their types'''
+        if payload.startswith('COMMIT'):
+            return COMMIT
+
+        match = CHANGE_RE.match(payload)
+        if not match:
+            return []  # BEGIN, or a message
+
+        op = match.group(2).lower()
+        if op == TRUNCATE:
+            # a single TRUNCATE of several tables lists all of them
+            return [(schema, table, op, {})
+                    for schema, table in split_names(match.group(1))]
+
+        schema, table = split_name(match.group(1))
+        data = match.group(3) or ''
+        if data in NO_DATA:
+            return [(schema, table, op, {})]
+
+        # updates of the key include the old key before the new tuple
+        if data.startswith('old-key: '):
+            data = data.split(' new-tuple: ', 1)[1]
+
+        row = {}
+        for name, typ, value in parse_columns(data):
+            if value == UNCHANGED_TOAST:
+                continue
+            if value is not None:
+                cast = self.get_cast(self.types.get(typ))
+                value = cast(value, self.cursor)
+            row[name] = value
+        return [(schema, table, op, row)]
+
+    def parse_pgoutput(self, payload):
+        '''parse a message of the pgoutput protocol (version 1)'''
+        kind = payload[0]
+        if kind == 'C':
+            return COMMIT
+
+        reader = MessageReader(payload, 1)
+        if kind == 'R':
+            relid = reader.int32()
+            schema = reader.string()
+            table = reader.string()
+            reader.int8()  # replica identity
+            columns = []
+            for i in range(reader.int16()):
+                reader.int8()  # flags
+                name = reader.string()
+                oid = reader.int32()
+                reader.int32()  # type modifier
+                columns.append((name, oid))
+            self.relations[relid] = (schema, table, columns)
+            return []
+
+        if kind in 'IUD':
+            schema, table, columns = self.relations[reader.int32()]
+            op = {'I': INSERT, 'U': UPDATE, 'D': DELETE}[kind]
+            tuple_kind = reader.byte()
+            if kind == 'U' and tuple_kind in 'KO':
+                self.read_tuple(reader, columns)  # the old key
+                tuple_kind = reader.byte()
+            row = self.read_tuple(reader, columns, key=tuple_kind == 'K')
+            return [(schema, table, op, row)]
+
+        if kind == 'T':
+            count = reader.int32()
+            reader.int8()  # options
+            changes = []
+            for i in range(count):
+                schema, table, columns = self.relations[reader.int32()]
+                changes.append((schema, table, TRUNCATE, {}))
+            return changes
+
+        return []  # BEGIN, ORIGIN, TYPE
+
+    def read_tuple(self, reader, columns, key=False):
+        '''read the values of a row. Only the key is sent for deleted rows
+        (unless the replica identity is full), the other columns are nulls
+        that are left out'''
+        row = {}
+        for i in range(reader.int16()):
+            name, oid = columns[i]
+            kind = reader.byte()
+            if kind == 'n' and not key:
+                row[name] = None
+            elif kind == 't':
+                value = reader.bytes(reader.int32())
+                row[name] = self.get_cast(oid)(value, self.cursor)
+            # unchanged TOAST values ('u') are not sent, they're left out
+        return row
+
+    def get_cast(self, oid):
+        cast = self.casts.get(oid)
+        if cast is None:
+            cast = self.casts[oid] = get_typecaster(oid)
+        return cast
+
+
+# returned by the parsers for the end of a transaction
+COMMIT = object()
+
+
+class MessageReader(object):
+    '''read the fields of a binary pgoutput message'''
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+
+    def unpack(self, fmt, size):
+        value = struct.unpack_from(fmt, self.data, self.pos)[0]
+        self.pos += size
+        return value
+
+    def int8(self):
+        return self.unpack('!b', 1)
+
+    def int16(self):
+        return self.unpack('!h', 2)
+
+    def int32(self):
+        return self.unpack('!i', 4)
+
+    def byte(self):
+        return self.bytes(1)
+
+    def bytes(self, size):
+        value = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return value
+
+    def string(self):
+        end = self.data.index('\0', self.pos)
+        value = self.data[self.pos:end]
+        self.pos = end + 1
+        return value
+
+
+def parse_columns(data):
+    '''parse the columns of a test_decoding change into a list of (name,
+    type, value) tuples, where the value is None for nulls'''
+    columns = []
+    pos = 0
+    while pos < len(data):
+        name, pos = read_ident(data, pos, '[')
+        end = data.index(']:', pos + 1)
+        typ = data[pos + 1:end]
+        pos = end + 2
+
+        if data[pos] == "'":
+            value, pos = read_quoted(data, pos, "'")
+        else:
+            end = data.find(' ', pos)
+            end = len(data) if end == -1 else end
+            value, pos = data[pos:end], end
+            value = None if value == 'null' else value
+
+        columns.append((name, typ, value))
+        pos += 1  # the space before the next column
+    return columns
+
+
+def read_ident(data, pos, stop):
+    '''read a (possibly quoted) identifier, up to the stop character'''
+    if data[pos] == '"':
+        return read_quoted(data, pos, '"')
+    end = data.index(stop, pos)
+    return data[pos:end], end
+
+
+def read_quoted(data, pos, quote):
+    '''read a quoted value, where quotes are escaped by doubling them'''
+    value = []
+    pos += 1
+    while True:
+        end = data.index(quote, pos)
+        value.append(data[pos:end])
+        if data[end + 1:end + 2] != quote:
+            return ''.join(value), end + 1
+        value.append(quote)
+        pos = end + 2
+
+
+def split_name(name):
+    '''split a qualified (possibly quoted) table name into its schema and
+    table names'''
+    schema, pos = read_ident(name, 0, '.')
+    if name[pos + 1] == '"':
+        return schema, read_quoted(name, pos + 1, '"')[0]
+    return schema, name[pos + 1:]
+
+
+def split_names(names):
+    '''split a list of qualified (possibly quoted) table names, separated by
+    commas, into their schema and table names'''
+    result = []
+    pos = 0
+    while pos < len(names):
+        schema, pos = read_ident(names, pos, '.')
+        if names[pos + 1] == '"':
+            table, pos = read_quoted(names, pos + 1, '"')
+        else:
+            end = names.find(', ', pos + 1)
+            end = len(names) if end < 0 else end
+            table, pos = names[pos + 1:end], end
+        result.append((schema, table))
+        pos += len(', ')
+    return result
+
+
+def parse_lsn(lsn):
+    '''convert an LSN from its text representation (X/Y) to an integer'''
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def format_lsn(lsn):
+    '''convert an LSN to its text representation (X/Y)'''
+    return '%X/%X' % (lsn >> 32, lsn & 0xFFFFFFFF)
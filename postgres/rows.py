@@ -0,0 +1,106 @@
+import collections
+
+
+class Batch(collections.Sequence):
+    '''a batch of rows that share the same columns and internals.
+
+    The values of each row are kept in the tuple read from the cursor, and
+    the internals (`__tablename`, `__schemaname` and `__state`) are kept
+    once for the whole batch instead of being copied into every row. Items
+    are read-only `Row` views that behave like the dicts of the default row
+    format'''
+
+    def __init__(self, columns, rows, internals):
+        self.columns = tuple(columns)
+        self.rows = rows
+        self.internals = internals
+        self._keys = self.columns + tuple(internals)
+        self._positions = dict((col, i) for i, col in enumerate(self.columns))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [Row(self, values) for values in self.rows[i]]
+        return Row(self, self.rows[i])
+
+    def __iter__(self):
+        for values in self.rows:
+            yield Row(self, values)
+
+    def __repr__(self):
+        return 'Batch(%s rows of %s)' % (len(self.rows), self.columns)
+
+
+class Row(object):
+    '''a read-only mapping view of a single row in a batch. Use `dict(row)`
+    to get a regular (modifiable) dict.
+
+    It doesn't extend `collections.Mapping` because on Python 2 the abstract
+    classes don't define `__slots__`, which would add a `__dict__` to every
+    row. It's registered as a Mapping instead'''
+
+    __slots__ = ('_batch', '_values')
+
+    def __init__(self, batch, values):
+        self._batch = batch
+        self._values = values
+
+    def __getitem__(self, key):
+        i = self._batch._positions.get(key)
+        if i is None:
+            return self._batch.internals[key]
+        return self._values[i]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self._batch._positions or key in self._batch.internals
+
+    def __iter__(self):
+        return iter(self._batch._keys)
+
+    def __len__(self):
+        return len(self._batch._keys)
+
+    def keys(self):
+        return list(self._batch._keys)
+
+    def values(self):
+        return list(self._values) + self._batch.internals.values()
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def copy(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.Mapping):
+            return NotImplemented
+        return self.copy() == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+collections.Mapping.register(Row)
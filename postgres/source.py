@@ -1,15 +1,236 @@
 import sys
+import json
+import time
+import datetime
 import panoply
 import uuid
 import psycopg2
 import psycopg2.extras
 import backoff
+from pool import Pool
+from copystream import CopyReader
+from rows import Batch, Row
+from metrics import Metrics, format_summary
+from metrics import CONNECT, DECLARE, FETCH, TYPECAST, ROWS, STATE
+from decoding import register_decoders
+from arrow import RecordBatchBuilder
+from catalog import CatalogCache, MARKER_QUERY
+from hosts import Hosts, get_hosts, get_lag, is_host_error
+from hosts import REPLICA, MAX_LAG
+from replication import ChangeReader, PLUGIN_TEST_DECODING, IDLE_TIMEOUT
+from batching import BatchSizer, MemoryBudget
+from batching import estimate_size, estimate_row_size, get_row_size
+from batching import SAMPLE_SIZE
+from batching import MIN_BATCH_SIZE, MAX_BATCH_SIZE
 
 DEST = '{__tablename}'
 BATCH_SIZE = 5000
 CONNECT_TIMEOUT = 15  # seconds
 MAX_RETRIES = 5
 RETRY_TIMEOUT = 2
+PARALLELISM = 1  # number of tables that are read concurrently
+PREFETCH = 0  # number of batches fetched in the background ahead of `read`
+
+# Resume modes: `offset` skips the already loaded rows with OFFSET while
+# `keyset` orders the table by its primary key (or a unique index) and
+# continues after the last key that was read
+RESUME_OFFSET = 'offset'
+RESUME_KEYSET = 'keyset'
+
+# Extraction modes: `cursor` fetches batches from a server side cursor while
+# `copy` streams the whole table with COPY TO STDOUT and parses the stream
+EXTRACT_CURSOR = 'cursor'
+EXTRACT_COPY = 'copy'
+
+# Row formats: `dict` returns every row as a dict that includes the internals
+# while `compact` returns a `Batch` of the tuples read from the database, with
+# the columns and internals shared by all of its rows, and `arrow` returns an
+# arrow `RecordBatch` with the internals in its metadata
+ROWS_DICT = 'dict'
+ROWS_COMPACT = 'compact'
+ROWS_ARROW = 'arrow'
+
+# Scheduling: `listed` reads the tables in the order they're listed while
+# `size` estimates the size of every table, reads the largest tables first and
+# reports the progress in (estimated) rows and bytes rather than tables
+SCHEDULE_LISTED = 'listed'
+SCHEDULE_SIZE = 'size'
+
+# The tables, views and foreign tables that the user can read, straight from
+# the catalog. information_schema.tables checks all of the privileges of every
+# table, which takes minutes on databases with many tables
+TABLES_QUERY = '''
+    SELECT
+        n.nspname AS table_schema,
+        c.relname AS table_name,
+        CASE c.relkind
+            WHEN 'v' THEN 'VIEW'
+            WHEN 'f' THEN 'FOREIGN'
+            ELSE 'BASE TABLE'
+        END AS table_type,
+        greatest(c.reltuples, 0)::bigint AS rows,
+        c.relpages::bigint * current_setting('block_size')::int AS bytes
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind IN ('r', 'p', 'v', 'f')
+        AND n.nspname <> 'information_schema'
+        AND n.nspname !~ '^pg_'
+        AND has_table_privilege(c.oid, 'SELECT')
+    ORDER BY n.nspname, c.relname
+'''
+
+# Find the primary key of a table, or the narrowest unique index over non
+# nullable columns when there's no primary key. Expression and partial indexes
+# can't be used for keyset pagination.
+KEY_QUERY = '''
+    SELECT ARRAY(
+        SELECT a.attname::text
+        FROM unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, ord)
+        JOIN pg_attribute a
+            ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+        ORDER BY k.ord
+    ) AS columns
+    FROM pg_index i
+    WHERE i.indrelid = %s::regclass
+        AND (i.indisprimary OR i.indisunique)
+        AND i.indpred IS NULL
+        AND i.indexprs IS NULL
+        AND NOT EXISTS (
+            SELECT 1 FROM pg_attribute a
+            WHERE a.attrelid = i.indrelid
+                AND a.attnum = ANY(i.indkey)
+                AND NOT a.attnotnull
+        )
+    ORDER BY i.indisprimary DESC, i.indnatts
+    LIMIT 1
+'''
+
+# Estimated size of a table, used to decide whether to split it into ranges
+SIZE_QUERY = '''
+    SELECT
+        c.reltuples::bigint AS rows,
+        c.relpages AS pages,
+        c.relkind AS kind,
+        current_setting('server_version_num')::int AS version
+    FROM pg_class c
+    WHERE c.oid = %s::regclass
+'''
+
+# The estimated number of rows and size (bytes) of a list of tables
+SIZES_QUERY = '''
+    SELECT
+        n.nspname || '.' || c.relname AS name,
+        greatest(c.reltuples, 0)::bigint AS rows,
+        c.relpages::bigint * current_setting('block_size')::int AS bytes
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname || '.' || c.relname = ANY(%s)
+'''
+
+# The leaf partitions of a declaratively partitioned table (through all of the
+# levels of sub-partitions), with their estimated number of rows and size
+PARTITIONS_QUERY = '''
+    WITH RECURSIVE tree AS (
+        SELECT c.oid, c.relkind
+        FROM pg_class c
+        WHERE c.oid = %s::regclass AND c.relkind = 'p'
+        UNION ALL
+        SELECT c.oid, c.relkind
+        FROM tree t
+        JOIN pg_inherits i ON i.inhparent = t.oid
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE t.relkind = 'p'
+    )
+    SELECT
+        n.nspname AS schema,
+        c.relname AS name,
+        greatest(c.reltuples, 0)::bigint AS rows,
+        c.relpages::bigint * current_setting('block_size')::int AS bytes
+    FROM tree t
+    JOIN pg_class c ON c.oid = t.oid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE t.relkind <> 'p'
+    ORDER BY n.nspname, c.relname
+'''
+
+# The columns of a table, used to validate the columns that are selected
+COLUMNS_QUERY = '''
+    SELECT a.attname::text AS name, format_type(a.atttypid, NULL) AS type
+    FROM pg_attribute a
+    WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+    ORDER BY a.attnum
+'''
+
+# Types whose values can be truncated to a number of bytes (or characters)
+TRUNCATE_TYPES = ('text', 'character varying', 'json', 'jsonb', 'xml',
+                  'bytea')
+
+INTEGER_TYPES = ('smallint', 'integer', 'bigint')
+TYPE_QUERY = '''
+    SELECT format_type(a.atttypid, NULL) AS type
+    FROM pg_attribute a
+    WHERE a.attrelid = %s::regclass AND a.attname = %s
+'''
+
+# The average width of the rows of a table, according to its statistics
+WIDTH_QUERY = '''
+    SELECT sum(avg_width)::int AS width, count(*)::int AS columns
+    FROM pg_stats
+    WHERE schemaname = %s AND tablename = %s
+'''
+
+# Change detection: tables that were not modified since they were last read
+# completely are skipped. `stats` compares the number of rows inserted, updated
+# and deleted by the statistics (with the file of the table, which changes
+# when it's truncated), `xmin` compares the number of rows and the newest xmin
+# (a scan of the table). The signatures are saved in the state
+CHANGES_STATS = 'stats'
+CHANGES_XMIN = 'xmin'
+CHANGES_STATE = '__changes'
+
+CHANGES_QUERY = '''
+    SELECT
+        n.nspname || '.' || c.relname AS name,
+        c.relkind AS kind,
+        concat_ws('/', s.n_tup_ins, s.n_tup_upd, s.n_tup_del, c.relfilenode,
+                  d.stats_reset) AS changes,
+        pg_is_in_recovery() AS recovery
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_stat_all_tables s ON s.relid = c.oid
+    LEFT JOIN pg_stat_database d ON d.datname = current_database()
+    WHERE n.nspname || '.' || c.relname = ANY(%s)
+'''
+XMIN_QUERY = '''
+    SELECT count(*) || '/' || coalesce(max(xmin::text::bigint), 0) AS changes
+    FROM {}
+'''
+
+# Change data capture reads the changes decoded from a logical replication
+# slot instead of the tables, and saves the LSN of the last change in the state
+SLOT = 'panoply'
+LSN_STATE = '__lsn'
+
+# The current end of the WAL, the changes up to it are read before the stream
+# is done, and the output plugin of the replication slot if it exists
+CDC_QUERY = '''
+    SELECT
+        pg_current_wal_lsn()::text AS lsn,
+        (
+            SELECT plugin::text FROM pg_replication_slots
+            WHERE slot_name = %s
+        ) AS plugin
+'''
+
+# The names of the types as they're formatted by test_decoding
+TYPES_QUERY = 'SELECT oid, format_type(oid, NULL) AS name FROM pg_type'
+
+# TID range scans (reading a range of ctids without a sequential scan of the
+# whole table) are only supported since Postgres 14
+TID_RANGE_VERSION = 140000
+
+# The error of a query with a column that doesn't exist (undefined_column)
+UNDEFINED_COLUMN = '42703'
 
 
 def _log_backoff(details):
@@ -21,6 +242,9 @@ def _log_backoff(details):
         err.message
     )
 
+    stream = details['args'][0]
+    stream.metrics.count('retries')
+
 
 # Used for testing - this constant is overriden durring tests so that we don't
 # actually have to wait for the retry
@@ -28,6 +252,13 @@ def _get_connect_timeout():
     return CONNECT_TIMEOUT
 
 
+retry = backoff.on_exception(backoff.expo,
+                             psycopg2.DatabaseError,
+                             max_tries=MAX_RETRIES,
+                             on_backoff=_log_backoff,
+                             base=_get_connect_timeout)
+
+
 class Postgres(panoply.DataSource):
 
     def __init__(self, source, options):
@@ -36,121 +267,1387 @@ class Postgres(panoply.DataSource):
         self.source['destination'] = self.source.get('destination', DEST)
 
         self.batch_size = self.source.get('__batchSize', BATCH_SIZE)
+        self.resume_mode = self.source.get('__resumeMode', RESUME_OFFSET)
+        self.parallelism = self.source.get('__parallelism', PARALLELISM)
+        self.prefetch = self.source.get('__prefetch', PREFETCH)
+        self.extract_mode = self.source.get('__extractMode', EXTRACT_CURSOR)
+        self.row_format = self.source.get('__rowFormat', ROWS_DICT)
+
+        # rows are fetched as tuples rather than dicts for the formats that
+        # keep the columns once per batch
+        self.tuples = self.row_format in (ROWS_COMPACT, ROWS_ARROW)
+
+        # timing spans and counters are passed to the `metrics` callback in
+        # the options, they're not measured at all without it
+        self.metrics = Metrics(self.options.get('metrics'))
+        self.schedule = self.source.get('__schedule', SCHEDULE_LISTED)
+
+        # track the highest value of the incremental key read from every table
+        # in its state, and continue after it in the next run
+        self.watermark = bool(self.source.get('inckey') and
+                              self.source.get('__watermark'))
+
+        # read the changes from a logical replication slot instead of the
+        # tables (change data capture)
+        self.cdc = bool(self.source.get('__cdc'))
+        self.slot = self.source.get('__slot', SLOT)
+        self.plugin = self.source.get('__plugin', PLUGIN_TEST_DECODING)
+
+        # the batch size is adjusted for every table to hit a target size
+        # (bytes) and/or latency (seconds) per batch when either is set
+        self.sizer = None
+        target_bytes = self.source.get('__batchBytes')
+        target_latency = self.source.get('__batchLatency')
+        if target_bytes or target_latency:
+            self.sizer = BatchSizer(
+                self.batch_size,
+                target_bytes=target_bytes,
+                target_latency=target_latency,
+                min_size=self.source.get('__minBatchSize', MIN_BATCH_SIZE),
+                max_size=self.source.get('__maxBatchSize', MAX_BATCH_SIZE)
+            )
+
+        # the batches held in memory at once (being fetched, ready for the
+        # next reads and the last one returned) are kept within a budget in
+        # bytes, FETCHes are shrunk to fit and the workers wait for the
+        # consumer to release earlier batches when it's used up
+        self.memory_budget = self.source.get('__memoryBudget')
+        self.budget = None
+        if self.memory_budget:
+            self.budget = MemoryBudget(self.memory_budget)
+        self.slots = 1  # the number of batches the budget is shared by
+        self.row_size = None  # the measured size of the rows of the table
+        self.budget_size = None
+        self.reserved = 0  # the size of the last batch that was read
+        self.held = 0  # the size of the last batch that was returned
+
+        # tables estimated to have more rows than `split_rows` are split into
+        # `split_ranges` ranges that are read (and checkpointed) separately
+        self.split_rows = self.source.get('__splitRows')
+
+        # partitioned tables are read partition by partition
+        self.partitions = bool(self.source.get('__partitions'))
+
+        # tables that were not modified since they were last read are skipped
+        self.skip_unchanged = self.source.get('__skipUnchanged')
+        if self.skip_unchanged is True:
+            self.skip_unchanged = CHANGES_STATS
+        self.signatures = {}
+        self.skipped = []
+
+        # with multiple hosts (a primary and its replicas) the tables are read
+        # from the replicas, every stream from the least loaded one that's
+        # healthy. Replication (cdc) always uses the primary
+        self.hosts = None
+        self.host = None  # the address of the host the stream is reading from
+        self.primary_source = self.source
+        if self.source.get('__hosts'):
+            self.hosts = Hosts(get_hosts(self.source),
+                               max_lag=self.source.get('__maxLag', MAX_LAG))
+            self.primary_source = dict(self.source,
+                                       addr=self.hosts.primary['addr'])
+
+        # the results of catalog queries are cached on disk in this directory
+        # until the catalog changes
+        self.catalog_cache = self.source.get('__catalogCache')
+        self.catalog = None
+        self.catalog_marker = None
+
+        self.split_ranges = self.source.get('__splitRanges', self.parallelism)
         tables = self.source.get('tables', [])
         self.tables = tables[:]
         self.index = 0
+        self.planned = False
         self.conn = None
         self.cursor = None
+        self.fetch_cursor = None
+        self.copy = None
+        self.columns = None
+        self.arrow = None
         self.state_id = None
         self.loaded = 0
+        self.key = None
+        self.pool = None
+        self.changes = None
+        self.completed = set()
+
+        # the estimated (rows, bytes) of every table, when scheduled by size
+        self.estimates = {}
+        self.total_rows = 0
+        self.done_rows = 0
+        self.done_bytes = 0
+        self.read_rows = 0
+        self.started = None
         self.saved_state = self.source.get('state', {})
 
+        # the LSN that the replication slot is advanced to: the one in the
+        # state the stream was started with, which was checkpointed. The LSN
+        # read since is only reported, and a retry within the run continues
+        # after it without advancing the slot, in case the run fails
+        self.flush_lsn = self.saved_state.get(LSN_STATE)
+
+        # By default the state is reported with every batch. Otherwise the
+        # batches share the same state id until the state is reported (a
+        # checkpoint) every N rows, every T seconds and at the end of every
+        # table, or only at the end of every table
+        self.checkpoint_rows = self.source.get('__checkpointRows')
+        self.checkpoint_seconds = self.source.get('__checkpointSeconds')
+        self.checkpoint_tables = self.source.get('__checkpointTables')
+        self.pending_states = {}
+        self.pending_rows = 0
+        self.last_checkpoint = time.time()
+
         # Remove the state object from the source definition
         # since it does not need to be saved on the source.
         self.source.pop('state', None)
 
-    @backoff.on_exception(backoff.expo,
-                          psycopg2.DatabaseError,
-                          max_tries=MAX_RETRIES,
-                          on_backoff=_log_backoff,
-                          base=_get_connect_timeout)
+    @retry
     def read(self, batch_size=None):
         batch_size = batch_size or self.batch_size
+
+        # the consumer is done with the last batch once it reads the next one
+        if self.held:
+            self.budget.release(self.held)
+            self.held = 0
+
+        if self.cdc:
+            return self.read_changes(batch_size)
+        if not self.planned:
+            self.plan()
+        if self.parallelism > 1 or self.prefetch:
+            return self.read_parallel(batch_size)
+
+        result = self.read_batch(batch_size)
+        if result is None:
+            self.close()
+        self.held = self.reserved
+        return result
+
+    def iter_batches(self, batch_size=None):
+        '''yield the batches of the tables as they're read, the same as
+        consecutive calls to `read` (without the empty batches at the end of
+        every table)'''
+        while True:
+            batch = self.read(batch_size)
+            if batch is None:
+                return
+            if batch:
+                yield batch
+
+    def iter_rows(self, batch_size=None):
+        '''yield the rows of the tables one by one. When the tables are read
+        one after the other the rows of every batch are built (and converted
+        by the cursor) as they're yielded, rather than all at once, and the
+        state of a batch is reported once all of its rows were yielded'''
+        if self.cdc or self.parallelism > 1 or self.prefetch:
+            for batch in self.iter_batches(batch_size):
+                for row in batch:
+                    yield row
+            return
+
+        try:
+            while True:
+                rows = self.read_lazy(batch_size or self.batch_size)
+                if rows is None:
+                    return
+                for row in rows:
+                    yield row
+        except GeneratorExit:
+            # the rest of the batch is discarded, the next read resumes from
+            # the last reported state
+            self.close()
+            raise
+
+    @retry
+    def read_lazy(self, batch_size):
+        '''fetch the next batch of the tables, and return an iterator over its
+        rows (None when there are no tables left)'''
+        if not self.planned:
+            self.plan()
+
+        current = self.start_batch()
+        if current is None:
+            self.close()
+            return None
+
+        self.metrics.start_batch()
+        if self.sizer:
+            batch_size = self.sizer.size
+        self.reserved = 0
+        if self.budget:
+            batch_size, self.reserved = self.reserve(batch_size)
+
+        start = time.time()
+        try:
+            if self.copy:
+                rows = self.fetch(batch_size)
+            else:
+                # the values are only converted to python objects as the rows
+                # are iterated over
+                with self.metrics.span(FETCH):
+                    self.execute(
+                        'FETCH FORWARD {} FROM cur'.format(batch_size),
+                        cursor=self.fetch_cursor
+                    )
+                self.columns = [c[0] for c in self.fetch_cursor.description]
+                rows = iter(self.fetch_cursor)
+        except Exception:
+            self.release()
+            raise
+
+        return self._iter_batch(current, rows, batch_size,
+                                time.time() - start)
+
+    def _iter_batch(self, current, rows, batch_size, seconds):
+        internals = self.get_internals(current)
+        compact = self.tuples
+        if compact:
+            batch = Batch(self.columns, [], internals)
+
+        # the size of the batch is estimated by a sample of its rows, for the
+        # memory budget and the batch sizer
+        measure = self.budget or (self.sizer and self.sizer.target_bytes)
+        step = max(1, batch_size // SAMPLE_SIZE)
+        sampled = nbytes = 0
+
+        # only the last rows are needed for the state of the batch: the last
+        # row, and the last row with a different incremental key (watermark)
+        inckey = [self.source.get('inckey')]
+        last = previous = None
+        count = 0
+        try:
+            for r in rows:
+                if self.watermark and last is not None and \
+                        self.get_values(r, inckey) != \
+                        self.get_values(last, inckey):
+                    previous = last
+                if measure and count % step == 0:
+                    sampled += 1
+                    nbytes += get_row_size(r)
+                last = r
+                count += 1
+                yield Row(batch, r) if compact else dict(r, **internals)
+        finally:
+            # the rows were handed over one by one, none of them are held
+            # once the batch is done
+            self.release()
+
+        nbytes = nbytes * count // sampled if sampled else 0
+        if self.budget and count:
+            self.row_size = max(1, nbytes // count)
+        if self.sizer:
+            self.update_sizer(count, nbytes or None, seconds)
+
+        self.loaded += count
+        self.metrics.count('rows', count)
+        tail = [r for r in (previous, last) if r is not None]
+        self.end_batch(current, tail, count, count >= batch_size)
+
+    def read_batch(self, batch_size):
+        '''read the next batch of the tables one after the other'''
+        self.reserved = 0
+        current = self.start_batch()
+        if current is None:
+            return None  # no tables left, we're done
+
+        self.metrics.start_batch()
+        if self.sizer:
+            batch_size = self.sizer.size
+        if self.budget:
+            batch_size, self.reserved = self.reserve(batch_size)
+
+        try:
+            return self.fetch_batch(current, batch_size)
+        except Exception:
+            # the batch is discarded and reserved again by the retry
+            self.release()
+            raise
+
+    def fetch_batch(self, current, batch_size):
+        '''fetch the next batch of the current table and build its rows'''
+        start = time.time()
+        fetched = self.fetch(batch_size)
+        if self.sizer:
+            nbytes = None
+            if self.sizer.target_bytes:
+                nbytes = estimate_size(fetched)
+            self.update_sizer(len(fetched), nbytes, time.time() - start)
+        if self.budget:
+            self.measure(fetched)
+
+        internals = self.get_internals(current)
+        with self.metrics.span(ROWS):
+            if self.row_format == ROWS_COMPACT and fetched:
+                result = Batch(self.columns, fetched, internals)
+            elif self.row_format == ROWS_ARROW and fetched:
+                result = self.arrow.build(fetched, internals)
+            else:
+                result = [dict(r, **internals) for r in fetched]
+        self.loaded += len(result)
+
+        if self.metrics.enabled and result:
+            self.metrics.count('rows', len(result))
+            self.metrics.count('bytes', estimate_size(fetched))
+
+        self.end_batch(current, fetched, len(fetched),
+                       len(fetched) >= batch_size)
+        return result
+
+    def start_batch(self):
+        '''start reading the next batch of the tables, the current table is
+        started when it's not read yet. Returns the current table, or None
+        when there are no tables left'''
         total = len(self.tables)
         if self.index >= total:
-            return None  # no tables left, we're done
+            return None
 
-        schema, table = self.tables[self.index]['value'].split('.', 1)
+        current = self.tables[self.index]
+        schema, table = current['value'].split('.', 1)
 
-        msg = 'Reading table {} ({}) out of {}'\
-              .format(self.index + 1, table, total)
-        self.progress(self.index + 1, total, msg)
+        if not self.estimates:
+            msg = 'Reading table {} ({}) out of {}{}'.format(
+                self.index + 1, table, total, self.describe_skipped())
+            self.progress(self.index + 1, total, msg)
 
-        if not self.cursor:
-            self.conn, self.cursor = connect(self.source)
-            state = self.saved_state.get("%s.%s" % (schema, table))
-            self.loaded = state if state is not None else 0
-            q = get_query(schema, table, self.source, state)
-            self.execute('DECLARE cur CURSOR FOR {}'.format(q))
+        # The connection is kept open for all of the tables, and only
+        # re-created after an error
+        if self.metrics.table != get_state_key(current):
+            self.metrics.start_table(get_state_key(current))
 
-        # read n(=BATCH_SIZE) records from the table
-        self.execute('FETCH FORWARD {} FROM cur'.format(batch_size))
-        result = self.cursor.fetchall()
+        if not self.conn:
+            with self.metrics.span(CONNECT):
+                self.conn, self.cursor = self.connect()
+
+        if not self.fetch_cursor:
+            self.fetch_cursor = self.cursor
+            if self.tuples:
+                # rows are fetched as tuples rather than dicts
+                self.fetch_cursor = self.conn.cursor()
+            state = self.saved_state.get(get_state_key(current))
+            self.key = self.get_key(schema, table, state)
+            self.loaded = get_loaded(state)
+            if self.sizer:
+                self.start_sizer(schema, table)
+            if self.budget:
+                self.row_size = self.get_row_size(schema, table)
+            select = self.get_select(schema, table, current)
+            q, params = get_query(schema, table, self.source, state, self.key,
+                                  current.get('__range'), select,
+                                  current.get('where'))
+            try:
+                if self.row_format == ROWS_ARROW:
+                    self.arrow = self.get_arrow(q, params)
+                with self.metrics.span(DECLARE):
+                    if self.extract_mode == EXTRACT_COPY:
+                        self.start_copy(q, params)
+                    else:
+                        self.execute('DECLARE cur CURSOR FOR {}'.format(q),
+                                     params)
+            except psycopg2.ProgrammingError, e:
+                # the columns (or key) of the table might be stale in the
+                # catalog cache, they're queried again by the retry
+                if e.pgcode == UNDEFINED_COLUMN and self.catalog:
+                    self.catalog.discard('"%s"."%s"' % (schema, table))
+                raise
+
+        return current
+
+    def get_internals(self, current):
+        '''return the internals of the rows of the next batch'''
+
+        # the rows of partitions are tagged with their partitioned table
+        name = current.get('__parent', current['value'])
+        schema, table = name.split('.', 1)
+
+        # a new state id is used for the rows after every checkpoint
+        if not self.pending_states:
+            self.state_id = str(uuid.uuid4())
 
-        self.state_id = str(uuid.uuid4())
         # Add __schemaname and __tablename to each row so it would be available
         # as `destination` parameter if needed and also in case multiple tables
         # are pulled into the same destination table.
         # state_id is also added in order to support checkpoints
-        internals = dict(
+        return dict(
             __tablename=table,
             __schemaname=schema,
             __state=self.state_id
         )
-        result = [dict(r, **internals) for r in result]
-        self.loaded += len(result)
+
+    def end_batch(self, current, rows, count, full):
+        '''finish reading a batch of `count` rows from the current table, by
+        its (last) fetched rows. `full` indicates that the whole batch size
+        was fetched, so that more rows might follow'''
 
         # no more rows for this table, clear and proceed to next table
-        if not result:
-            self.close()
+        if not count:
+            self.pending_states.update(self.record_changes(current) or
+                                       self.record_done(current))
+            self.checkpoint()
+            self.end_table()
             self.index += 1
-            self.loaded = 0
+            summary = self.metrics.end_table()
+            if summary:
+                self.log(format_summary(summary))
         else:
-            self._report_state(internals, self.loaded)
+            with self.metrics.span(STATE):
+                self._report_state(self.get_state(rows, full), count)
+
+        if self.estimates:
+            self.report_progress(current, count, self.index)
+
+    def read_parallel(self, batch_size):
+        '''read the next batch of whichever table is ready first, while up to
+        `parallelism` tables are read concurrently over separate connections.
+        Every worker tags its rows as usual and the state of a batch is
+        reported when it's returned, so checkpoints keep working per table.
+
+        The workers read ahead in the background, up to `prefetch` batches
+        (or one batch per worker) are kept ready for the next reads'''
+        total = len(self.tables)
+        if not self.pool:
+            tables = [t for t in self.tables
+                      if get_state_key(t) not in self.completed]
+            if not tables:
+                return None  # no tables left, we're done
+
+            # When a worker fails the pool is stopped and the error is raised
+            # for the retry, which starts a new pool over the tables that are
+            # not done yet, resuming each from the last state returned.
+            depth = self.prefetch or self.parallelism
+            budget = None
+            if self.memory_budget:
+                # the budget is shared by the batches queued, being fetched
+                # by every worker and the one returned to the consumer. Every
+                # pool gets a new one, the batches of a stopped pool are gone
+                self.budget = budget = MemoryBudget(self.memory_budget)
+                self.slots = depth + self.parallelism + 1
+                self.held = 0
+            self.pool = Pool(self._worker, tables, self.parallelism, depth,
+                             batch_size, budget).start()
+
+        try:
+            item = self.pool.get()
+        except Exception:
+            self.pool = None
+            raise
+
+        if item is None:
+            self.pool = None
+            self.index = total
+            return None
+
+        table, result, state, self.held = item
+        states = dict(state['state']) if state else {}
+
+        # an empty batch indicates that the worker is done with this table
+        if not result:
+            self.completed.add(get_state_key(table))
+            self.index = len(self.completed)
+            states.update(self.record_changes(table))
+
+        if states:
+            if state:
+                self.state_id = state['stateId']
+            self.saved_state.update(states)
+            self.state(self.state_id, states)
+
+        if self.estimates:
+            self.report_progress(table, len(result), len(self.completed))
+        else:
+            msg = 'Reading tables ({} at a time), {} out of {} done{}'\
+                  .format(self.parallelism, len(self.completed), total,
+                          self.describe_skipped())
+            self.progress(len(self.completed), total, msg)
 
         return result
 
-    def execute(self, query):
+    def read_changes(self, batch_size):
+        '''read the next batch of changes from the replication slot. Every
+        change is a row with the values of the inserted or updated row (or
+        the key of the deleted row), along with its `__op` and `__lsn`.
+
+        The LSN of the last transaction that was completely read is reported
+        as the state, and the slot is advanced to it when a stream is started
+        from that state, after it was checkpointed'''
+        if not self.changes:
+            self.start_changes()
+
+        try:
+            changes = self.changes.read(batch_size)
+        except psycopg2.DatabaseError, e:
+            self.reset()
+            raise
+
+        if not changes:
+            self.checkpoint()
+            self.close()
+            return None  # caught up, we're done
+
+        # a new state id is used for the rows after every checkpoint
+        if not self.pending_states:
+            self.state_id = str(uuid.uuid4())
+        result = [
+            dict(row,
+                 __tablename=table,
+                 __schemaname=schema,
+                 __state=self.state_id,
+                 __op=op,
+                 __lsn=lsn)
+            for schema, table, op, row, lsn in changes
+        ]
+        self.loaded += len(result)
+        self.log('Read %s changes from slot %s, last committed LSN: %s'
+                 % (self.loaded, self.slot, self.changes.lsn))
+
+        if self.changes.lsn:
+            self.saved_state[LSN_STATE] = self.changes.lsn
+            self.add_checkpoint({LSN_STATE: self.changes.lsn}, len(result))
+
+        return result
+
+    def start_changes(self):
+        '''start streaming the changes from the replication slot after the
+        saved LSN, the slot is created when it doesn't exist'''
+        if not self.conn:
+            self.conn, self.cursor = connect(self.primary_source)
+
+        self.execute(CDC_QUERY, (self.slot,))
+        current = self.cursor.fetchone()
+        plugin = current['plugin'] or self.plugin
+        types = None
+        if plugin == PLUGIN_TEST_DECODING:
+            self.execute(TYPES_QUERY)
+            types = dict((r['name'], r['oid']) for r in self.cursor.fetchall())
+        self.conn.rollback()
+
+        conn, cursor = connect(self.primary_source,
+                               psycopg2.extras.LogicalReplicationConnection,
+                               psycopg2.extras.ReplicationCursor)
+        self.changes = ChangeReader(
+            conn, cursor, self.slot, plugin,
+            publication=self.source.get('__publication'),
+            start_lsn=self.saved_state.get(LSN_STATE),
+            end_lsn=current['lsn'],
+            types=types,
+            tables=[t['value'] for t in self.tables],
+            idle_timeout=self.source.get('__idleTimeout', IDLE_TIMEOUT),
+            flush_lsn=self.flush_lsn
+        )
+        self.log('Streaming changes from slot %s (%s) after LSN %s'
+                 % (self.slot, plugin, self.changes.lsn))
+        try:
+            self.changes.start(create=current['plugin'] is None)
+        except psycopg2.DatabaseError, e:
+            self.reset()
+            raise
+
+    def _worker(self):
+        '''create a stream for a worker of the pool, it uses the same source
+        with its own connection and a copy of the current state'''
+        source = dict(self.source, state=dict(self.saved_state), tables=[])
+        source['__parallelism'] = 1
+        source['__prefetch'] = 0
+        stream = type(self)(source, self.options)
+        stream.budget = self.budget
+        stream.slots = self.slots
+        stream.hosts = self.hosts
+        stream.catalog_marker = self.catalog_marker
+        return stream
+
+    def plan(self):
+        '''expand the list of tables into the units that are read. Large
+        tables are split into ranges, each read and checkpointed on its own
+        so that they can be read concurrently, and so that a restart only
+        re-reads the ranges that were not finished. Partitioned tables are
+        expanded into their partitions the same way'''
+        tables = []
+        try:
+            if self.catalog_cache:
+                # the marker is queried once per run rather than by every
+                # worker, it sums over the catalogs of all of the columns
+                if not self.conn:
+                    self.conn, self.cursor = self.connect()
+                self.get_catalog()
+
+            sizes = {}
+            if self.schedule == SCHEDULE_SIZE:
+                sizes = self.get_sizes()
+
+            for table in self.tables:
+                # the ranges are saved in the state because they have to stay
+                # the same when the stream is resumed
+                state = self.saved_state.get(table['value'])
+
+                # a table that was already read as a whole keeps being read
+                # that way when it's resumed
+                leaves = None
+                if self.partitions and state is None:
+                    leaves = self.get_partitions(table)
+                if leaves is not None:
+                    units = partition_table(table, leaves)
+                    tables.extend(units)
+                    if self.schedule == SCHEDULE_SIZE:
+                        for unit, leaf in zip(units, leaves):
+                            self.estimates[get_state_key(unit)] = (
+                                leaf['rows'], leaf['bytes'])
+                    continue
+
+                ranges = None
+                if isinstance(state, dict) and 'ranges' in state:
+                    ranges = state
+                elif self.split_rows and self.split_ranges > 1 and not state:
+                    ranges = self.get_ranges(*table['value'].split('.', 1))
+
+                units = split_table(table, ranges) if ranges else [table]
+                tables.extend(units)
+
+                # the estimate of a table is split evenly between its ranges
+                if self.schedule == SCHEDULE_SIZE:
+                    rows, size = sizes.get(table['value'], (0, 0))
+                    for unit in units:
+                        self.estimates[get_state_key(unit)] = (
+                            rows // len(units), size // len(units))
+
+            if self.skip_unchanged and tables:
+                tables = self.skip_unchanged_tables(tables)
+            tables = self.pending_units(tables)
+        finally:
+            # the connection is only used by the workers in parallel mode
+            if self.parallelism > 1 or self.prefetch:
+                self.close()
+            else:
+                self.end_table()
+
+        if self.schedule == SCHEDULE_SIZE:
+            # the largest tables are read first, so that they don't straggle
+            # at the end of the run while the other workers are idle
+            tables.sort(key=lambda t: self.estimates[get_state_key(t)][0],
+                        reverse=True)
+            self.total_rows = sum(r for r, b in self.estimates.values())
+            self.done_rows = sum(
+                get_loaded(self.saved_state.get(get_state_key(t)))
+                for t in tables
+            )
+            self.started = time.time()
+
+        self.tables = tables
+        self.planned = True
+
+    def pending_units(self, units):
+        '''return the units that were not read to the end yet, see
+        `record_done`'''
+        pending = []
+        for unit in units:
+            state = self.saved_state.get(get_state_key(unit))
+            if isinstance(state, dict) and state.get('done'):
+                self.estimates.pop(get_state_key(unit), None)
+            else:
+                pending.append(unit)
+        return pending
+
+    def skip_unchanged_tables(self, tables):
+        '''return the tables (units) that were modified since they were last
+        read completely, by the signatures of their changes saved in the
+        state. The signatures are kept to be saved once they're read'''
+        if not self.conn:
+            self.conn, self.cursor = self.connect()
+
+        self.execute(CHANGES_QUERY, (list(set(t['value'] for t in tables)),))
+        signatures = {}
+        for row in self.cursor.fetchall():
+            # views (and partitioned tables) have no changes of their own
+            if row['kind'] not in ('r', 'm'):
+                continue
+
+            if self.skip_unchanged == CHANGES_XMIN:
+                schema, table = row['name'].split('.', 1)
+                self.execute(XMIN_QUERY.format(
+                    '"%s"."%s"' % (schema, table)))
+                signatures[row['name']] = self.cursor.fetchone()['changes']
+            elif row['recovery']:
+                # the statistics of standbys don't count the changes
+                # replicated from the primary
+                self.log('Statistics are not tracked on standby servers, '
+                         'unchanged tables are not skipped')
+                break
+            else:
+                signatures[row['name']] = row['changes']
+
+        saved = self.saved_state.get(CHANGES_STATE) or {}
+        changed = []
+        for table in tables:
+            key = get_state_key(table)
+            signature = signatures.get(table['value'])
+            if signature is not None and saved.get(key) == signature:
+                self.skipped.append(key)
+                self.estimates.pop(key, None)
+                continue
+
+            changed.append(table)
+            if signature is not None:
+                self.signatures[key] = signature
+
+        if self.skipped:
+            self.log('Skipping {} unchanged tables: {}'.format(
+                len(self.skipped), ', '.join(self.skipped)))
+        return changed
+
+    def record_changes(self, table):
+        '''return the states that record the signature of the changes of a
+        table (as it was planned) once it was read completely. The position
+        of the table is cleared along with it, so that the table is read from
+        the start once it changed, while a restart skips it as unchanged.
+        With watermarks the position is kept, it's carried over to the next
+        run'''
+        key = get_state_key(table)
+        signature = self.signatures.get(key)
+        if signature is None:
+            return {}
+
+        changes = dict(self.saved_state.get(CHANGES_STATE) or {})
+        changes[key] = signature
+        self.saved_state[CHANGES_STATE] = changes
+        if self.watermark:
+            return {CHANGES_STATE: changes}
+
+        self.saved_state[key] = None
+        return dict(get_plan_state(table), **{CHANGES_STATE: changes,
+                                              key: None})
+
+    def record_done(self, current):
+        '''return the state of a range (or partition) that was read to the
+        end, which is left out when the table is resumed rather than read
+        again up to its last offset. With watermarks the state is kept as is,
+        it's carried over to the next run'''
+        if self.watermark or not ('__range' in current or
+                                  '__parent' in current):
+            return {}
+
+        key = get_state_key(current)
+        state = self.saved_state.get(key)
+        done = dict(state) if isinstance(state, dict) else {}
+        done.update(done=True, loaded=self.loaded)
+        self.saved_state[key] = done
+        return dict(get_plan_state(current), **{key: done})
+
+    def describe_skipped(self):
+        '''return the note of the unchanged tables that were skipped, for the
+        progress messages'''
+        if not self.skipped:
+            return ''
+        return ', {} unchanged skipped'.format(len(self.skipped))
+
+    def get_partitions(self, table):
+        '''return the leaf partitions of a partitioned table, or None when the
+        table is not partitioned. The partitions that can't hold rows that
+        match the incremental key or the filter of the table (the ones that
+        Postgres prunes from the query of the whole table) are left out'''
+        if not self.conn:
+            self.conn, self.cursor = self.connect()
+
+        schema, name = table['value'].split('.', 1)
+        relation = '"%s"."%s"' % (schema, name)
+        leaves = self.query_catalog('partitions', relation, PARTITIONS_QUERY,
+                                    (relation,))
+        if not leaves:
+            return None
+
+        if not (self.source.get('inckey') or table.get('where')):
+            return leaves
+
+        q, params = get_query(schema, name, self.source,
+                              condition=table.get('where'))
+        self.execute('EXPLAIN (VERBOSE, FORMAT JSON) ' + q, params)
+        plan = self.cursor.fetchone()['QUERY PLAN']
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)  # json is decoded as text
+        scanned = set(get_relations(plan[0]['Plan']))
+
+        kept = [l for l in leaves if (l['schema'], l['name']) in scanned]
+        if len(kept) < len(leaves):
+            self.log('Skipping {} out of {} partitions of {} that have no '
+                     'matching rows'.format(len(leaves) - len(kept),
+                                            len(leaves), table['value']))
+        return kept
+
+    def get_sizes(self):
+        '''return the estimated number of rows and size in bytes of each of
+        the tables, by the statistics in pg_class'''
+        if not self.conn:
+            self.conn, self.cursor = self.connect()
+
+        names = [t['value'] for t in self.tables]
+        self.execute(SIZES_QUERY, (names,))
+        return dict((r['name'], (r['rows'], r['bytes']))
+                    for r in self.cursor.fetchall())
+
+    def report_progress(self, table, rows, done):
+        '''report the progress in estimated rows and bytes, with the time
+        left estimated by the throughput of the run so far'''
+        est_rows, est_bytes = self.estimates.get(get_state_key(table), (0, 0))
+        self.read_rows += rows
+        self.done_rows += rows
+        if est_rows:
+            self.done_bytes += rows * est_bytes // est_rows
+
+        # the estimates might be off, or outdated
+        total_rows = max(self.total_rows, self.done_rows)
+        total_bytes = max(sum(b for r, b in self.estimates.values()),
+                          self.done_bytes)
+
+        eta = 'unknown'
+        elapsed = time.time() - self.started
+        if self.read_rows and elapsed > 0:
+            left = (total_rows - self.done_rows) * elapsed / self.read_rows
+            eta = str(datetime.timedelta(seconds=int(left)))
+
+        msg = 'Read {:,} out of ~{:,} rows (~{:.1f} out of ~{:.1f} MB), ' \
+              '{} out of {} tables done{}, ETA: {}'.format(
+                  self.done_rows, total_rows, self.done_bytes / 1e6,
+                  total_bytes / 1e6, done, len(self.tables),
+                  self.describe_skipped(), eta)
+        self.progress(self.done_rows, total_rows, msg)
+
+    def get_ranges(self, schema, table):
+        '''return the ranges to split the table into, or None when the table is
+        too small to be split. Tables with an integer primary key are split
+        by ranges of the key, otherwise by ranges of pages (ctids)'''
+        if not self.conn:
+            self.conn, self.cursor = self.connect()
+
+        name = '"%s"."%s"' % (schema, table)
+        self.execute(SIZE_QUERY, (name,))
+        size = self.cursor.fetchone()
+        if size['kind'] not in ('r', 'm') or size['rows'] < self.split_rows:
+            return None
+
+        row = self.query_catalog('keys', name, KEY_QUERY, (name,), one=True)
+        key = row.get('columns')
+        if key and len(key) == 1:
+            self.execute(TYPE_QUERY, (name, key[0]))
+            if self.cursor.fetchone()['type'] in INTEGER_TYPES:
+                column = quote_ident(key[0])
+                self.execute('SELECT min({0}) AS lower, max({0}) AS upper '
+                             'FROM {1}'.format(column, name))
+                bounds = self.cursor.fetchone()
+                if bounds['lower'] is None:
+                    return None  # the table is actually empty
+
+                return {
+                    'column': key[0],
+                    'ranges': split_bounds(bounds['lower'], bounds['upper'],
+                                           self.split_ranges)
+                }
+
+        # Ranges of ctids are a sequential scan of the whole table on older
+        # versions, which is worse than not splitting the table at all
+        if size['version'] < TID_RANGE_VERSION:
+            return None
+
+        return {
+            'column': 'ctid',
+            'ranges': split_bounds(0, size['pages'], self.split_ranges)
+        }
+
+    def get_key(self, schema, table, state=None):
+        '''return the list of columns used to resume the table by key, or
+        None when the table should be resumed with OFFSET'''
+
+        # tables are ordered by the incremental key to track its watermark
+        if self.watermark:
+            return None
+
+        # A table that was checkpointed by key keeps resuming by the same key,
+        # and a table checkpointed with an OFFSET keeps using it since the
+        # offset is meaningless under a different ordering.
+        if isinstance(state, dict):
+            return state.get('columns')
+        if state is not None or self.resume_mode != RESUME_KEYSET:
+            return None
+
+        name = '"%s"."%s"' % (schema, table)
+        row = self.query_catalog('keys', name, KEY_QUERY, (name,), one=True)
+
+        # views and tables without a primary key or a usable unique index
+        # fall back to OFFSET
+        return row.get('columns') or None
+
+    def get_select(self, schema, table, current):
+        '''return the list of columns to select from a table, or None to
+        select all of them. The columns to include (`columns`) or exclude
+        (`exclude`) and the row filter (`where`) of the table are validated
+        against the catalog, and values larger than `truncate` bytes are
+        truncated by the server'''
+        include = current.get('columns')
+        exclude = current.get('exclude') or []
+        truncate = current.get('truncate', self.source.get('__truncate'))
+        where = current.get('where')
+        if not (include or exclude or truncate or where):
+            return None
+
+        name = '"%s"."%s"' % (schema, table)
+        columns = self.query_catalog('columns', name, COLUMNS_QUERY, (name,))
+
+        names = [c['name'] for c in columns]
+        unknown = [c for c in (include or []) + exclude if c not in names]
+        if unknown and self.catalog:
+            # the cached columns might be stale
+            self.catalog.discard(name)
+            columns = self.query_catalog('columns', name, COLUMNS_QUERY,
+                                         (name,))
+            names = [c['name'] for c in columns]
+            unknown = [c for c in (include or []) + exclude
+                       if c not in names]
+        if unknown:
+            raise panoply.PanoplyException(
+                'Unknown columns in {}.{}: {}'.format(
+                    schema, table, ', '.join(unknown)),
+                retryable=False
+            )
+
+        if where:
+            try:
+                self.execute('SELECT 1 FROM {} WHERE ({}) LIMIT 0'
+                             .format(name, where))
+            except (psycopg2.ProgrammingError, psycopg2.DataError), e:
+                raise panoply.PanoplyException(
+                    'Invalid filter for {}.{}: {}'.format(
+                        schema, table, e.message.strip()),
+                    retryable=False
+                )
+
+        # the columns that the state is tracked by are always selected
+        required = list(self.key or [])
+        if self.watermark:
+            required.append(self.source['inckey'])
+
+        select = []
+        for col in columns:
+            selected = (not include or col['name'] in include) and \
+                col['name'] not in exclude
+            if not selected and col['name'] not in required:
+                continue
+
+            ident = quote_ident(col['name'])
+            if not truncate or col['type'] not in TRUNCATE_TYPES or \
+                    col['name'] in required:
+                select.append(ident)
+            elif col['type'] == 'bytea':
+                select.append('substring({0} FROM 1 FOR {1:d}) AS {0}'
+                              .format(ident, truncate))
+            else:
+                select.append('left({0}::text, {1:d}) AS {0}'
+                              .format(ident, truncate))
+
+        if not select:
+            raise panoply.PanoplyException(
+                'No columns selected from {}.{}'.format(schema, table),
+                retryable=False
+            )
+
+        if not (include or exclude or truncate):
+            return None
+        return select
+
+    def start_copy(self, query, params=None):
+        '''start streaming the results of the query with COPY'''
+        self.log('COPY', query, "Loaded: %s" % self.loaded)
+        try:
+            self.copy = CopyReader(self.conn, self.cursor, query, params,
+                                   tuples=self.tuples)
+        except psycopg2.DatabaseError, e:
+            self.reset(e)
+            raise
+        self.copy.start()
+
+    def fetch(self, batch_size):
+        '''read n(=BATCH_SIZE) records from the current table'''
+        if not self.copy:
+            # the rows are received by the FETCH, and their values are only
+            # converted to python objects when they're fetched from the cursor
+            with self.metrics.span(FETCH):
+                self.execute('FETCH FORWARD {} FROM cur'.format(batch_size),
+                             cursor=self.fetch_cursor)
+            self.columns = [col[0] for col in self.fetch_cursor.description]
+            with self.metrics.span(TYPECAST):
+                return self.fetch_cursor.fetchall()
+
+        try:
+            # the values are converted as the COPY stream is parsed
+            with self.metrics.span(FETCH):
+                result = self.copy.read(batch_size)
+        except psycopg2.DatabaseError, e:
+            self.reset(e)
+            raise
+
+        self.columns = self.copy.columns
+        return result
+
+    def get_arrow(self, query, params=None):
+        '''return the builder of the record batches of a query, by the types
+        of its columns'''
+        self.execute('SELECT * FROM ({}) q LIMIT 0'.format(query), params)
+        # the types with decoders registered on the connection are text
+        text_types = getattr(self.conn, 'string_types', None)
+        if not isinstance(text_types, dict):
+            text_types = {}
+        arrow = RecordBatchBuilder(self.cursor.description, text_types)
+        arrow.register(self.conn)
+        return arrow
+
+    def start_sizer(self, schema, table):
+        '''start sizing the batches of a table, from the average width of its
+        rows when targeting a size in bytes'''
+        row_size = None
+        if self.sizer.target_bytes:
+            row_size = self.get_row_size(schema, table)
+
+        size = self.sizer.start(row_size)
+        self.log('Batch size: %s rows (min %s, max %s), estimated row size: %s'
+                 % (size, self.sizer.min_size, self.sizer.max_size, row_size))
+
+    def get_row_size(self, schema, table):
+        '''return the estimated size of the rows of a table in memory, by the
+        average width of its rows, or None when it's not analyzed'''
+        self.execute(WIDTH_QUERY, (schema, table))
+        row = self.cursor.fetchone()
+        if row and row['width']:
+            return estimate_row_size(row['width'], row['columns'])
+        return None
+
+    def reserve(self, batch_size):
+        '''shrink the next batch to its share of the memory budget, by the
+        size of the rows of the current table, and reserve its size. Blocks
+        until earlier batches are released when the budget is used up.
+        Returns the batch size and the reserved bytes'''
+        if self.row_size:
+            share = self.budget.limit // self.slots
+            size = max(1, min(batch_size, share // self.row_size))
+        else:
+            # the rows are measured with a small batch first
+            size = min(batch_size, MIN_BATCH_SIZE)
+
+        if size < batch_size and size != self.budget_size:
+            self.log('Batch size: %s rows to fit in the memory budget of %s '
+                     'bytes, estimated row size: %s'
+                     % (size, self.budget.limit, self.row_size))
+        self.budget_size = size
+
+        reserved = size * (self.row_size or 0)
+        self.budget.acquire(reserved)
+        return size, reserved
+
+    def release(self):
+        '''release the reservation of the last batch from the budget'''
+        if self.budget and self.reserved:
+            self.budget.release(self.reserved)
+        self.reserved = 0
+
+    def measure(self, rows):
+        '''replace the reservation of a batch with the size of its rows'''
+        nbytes = estimate_size(rows)
+        self.budget.adjust(self.reserved, nbytes)
+        self.reserved = nbytes
+        if rows:
+            self.row_size = max(1, nbytes // len(rows))
+
+    def update_sizer(self, rows, nbytes, seconds):
+        '''adjust the batch size by the number of rows, size (bytes, when
+        targeting a size) and latency of the last batch'''
+        previous = self.sizer.size
+        size = self.sizer.update(rows, nbytes, seconds)
+        if size != previous:
+            self.log('Batch size: %s rows (min %s, max %s), last batch: '
+                     '%s rows, %s bytes in %.3fs'
+                     % (size, self.sizer.min_size, self.sizer.max_size,
+                        rows, nbytes, seconds))
+
+    def get_state(self, rows, full):
+        '''return the state of the current table after the given (fetched)
+        rows were read'''
+        if self.watermark:
+            return {'watermark': self.get_watermark(rows, full)}
+
+        if self.key:
+            last = self.get_values(rows[-1], self.key)
+            return {
+                'columns': self.key,
+                'key': [serialize_key(v) for v in last],
+                'loaded': self.loaded
+            }
+
+        return self.loaded
+
+    def get_watermark(self, rows, full):
+        '''return the highest value of the incremental key that all of the
+        rows with that value were read.
+
+        The rows are ordered by the incremental key, so when the batch is full
+        more rows with the same value as the last row might follow, and the
+        watermark is the value just before it. Resuming after it reads the
+        rows with the last value again, rather than missing some of them.
+
+        NULLs are never a watermark, they're sorted after all of the other
+        values, so once they're reached the rest of the values were read'''
+        inckey = [self.source['inckey']]
+        values = [self.get_values(row, inckey)[0] for row in rows]
+        nulls = None in values
+        values = [v for v in values if v is not None]
+        if values and (not full or nulls):
+            # the table was read to the end, or up to its NULLs
+            return serialize_key(values[-1])
+
+        for value in reversed(values):
+            if value != values[-1]:
+                return serialize_key(value)
+
+        # all of the rows have the same value (or NULL), keep the previous
+        # watermark
+        state = self.saved_state.get(get_state_key(self.tables[self.index]))
+        return state.get('watermark') if isinstance(state, dict) else None
+
+    def get_values(self, row, columns):
+        '''return the values of the columns in a fetched row'''
+        if self.tuples:
+            return [row[self.columns.index(c)] for c in columns]
+        return [row[c] for c in columns]
+
+    def execute(self, query, params=None, cursor=None):
         self.log(query, "Loaded: %s" % self.loaded)
+        cursor = cursor or self.cursor
         try:
-            self.cursor.execute(query)
+            if params:
+                cursor.execute(query, params)
+            else:
+                cursor.execute(query)
         except psycopg2.DatabaseError, e:
             # We're ensuring that there is no connection or cursor objects
             # after an exception so that when we retry,
             # a new connection will be created.
-            self.reset()
+            self.reset(e)
             raise
         self.log("DONE", query)
 
+    def end_table(self):
+        '''stop reading the current table, keeping the connection open for
+        the next one'''
+        if self.copy:
+            self.copy.close()
+        if self.fetch_cursor and self.fetch_cursor is not self.cursor:
+            self.fetch_cursor.close()
+        if self.conn:
+            # psycopg2 uses transactions for everything, ending the transaction
+            # also closes the `cur` cursor so it can be declared again
+            self.conn.rollback()
+
+        self.loaded = 0
+        self.key = None
+        self.copy = None
+        self.fetch_cursor = None
+
     def close(self):
         '''close the connection, and clear everything'''
+        if self.pool:
+            self.pool.stop()
+            self.pool = None
+
+        self.end_table()
+        self.save_catalog()
         if self.cursor:
             self.cursor.close()
         if self.conn:
-            # psycopg2 uses transactions for everything, hence we use rollback
-            # to cleanly exit the transaction although conn.close should do it
-            # implicitly
-            self.conn.rollback()
             self.conn.close()
+            self.conn = None
 
         self.reset()
 
-    def reset(self):
+    def reset(self, error=None):
+        '''discard the connection, so that a new one is created by the next
+        read. Used after errors, when the connection might be broken. With
+        multiple hosts, the host is failed over when the error is caused by
+        the host itself'''
+        if self.host:
+            if error is not None and is_host_error(error):
+                self.log('Failing over from host %s: %s'
+                         % (self.host, error))
+                self.hosts.fail(self.host)
+            self.hosts.release(self.host)
+            self.host = None
+
+        if self.copy:
+            self.copy.stopped.set()
+        if self.changes:
+            self.changes.close()
+        if self.conn:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass  # it's discarded anyway
+
         self.loaded = 0
+        self.key = None
+        self.copy = None
+        self.changes = None
         self.conn = None
         self.cursor = None
+        self.fetch_cursor = None
+
+    def connect(self):
+        '''connect to the source. With multiple hosts, to the least loaded of
+        the healthy replicas, or to the primary when none of them is. Hosts
+        that can't be connected to, and replicas that lag behind by more than
+        `__maxLag` seconds, are failed over'''
+        if not self.hosts:
+            return connect(self.source)
+
+        error = None
+        tried = set()
+        while True:
+            host = self.hosts.pick(tried)
+            if host is None:
+                raise error
+            addr = host['addr']
+            tried.add(addr)
+
+            conn = None
+            try:
+                conn, cursor = connect(dict(self.source, addr=addr))
+                lag = 0
+                if host['role'] == REPLICA:
+                    lag = get_lag(conn, cursor)
+            except psycopg2.OperationalError, e:
+                self.log('Failing over from host %s: %s' % (addr, e))
+                self.hosts.fail(addr)
+                self.hosts.release(addr)
+                if conn:
+                    conn.close()
+                error = e
+                continue
+            except Exception:
+                # not a failure of the host (the login failed, the lag can't
+                # be queried), it's raised as is without keeping its load
+                self.hosts.release(addr)
+                if conn:
+                    conn.close()
+                raise
+
+            if lag > self.hosts.max_lag:
+                self.log('Skipping host %s, replication lag: %.1f seconds'
+                         % (addr, lag))
+                self.hosts.fail(addr)
+                self.hosts.release(addr)
+                conn.close()
+                continue
+
+            self.log('Reading from host %s (%s)' % (addr, host['role']))
+            self.host = addr
+            return conn, cursor
 
     def get_tables(self):
         '''get the list of tables from the source'''
-        query = '''
-            SELECT * FROM information_schema.tables
-            WHERE table_schema NOT IN ('information_schema', 'pg_catalog')
-        '''
 
-        self.conn, self.cursor = connect(self.source)
-        self.execute(query)
-        result = map(format_table_name, self.cursor.fetchall())
+        # the connection of the stream is used when it's already open
+        opened = not self.conn
+        if opened:
+            self.conn, self.cursor = self.connect()
+
+        rows = self.query_catalog('tables', '', TABLES_QUERY)
+        result = map(format_table_name, rows)
+
+        if opened:
+            self.close()
+
+        return result
+
+    def get_catalog(self):
+        '''return the catalog cache, or None when it's disabled. It's loaded
+        on first use, by the current marker of the catalog (or the marker of
+        the stream that started the worker)'''
+        if not self.catalog_cache:
+            return None
 
-        self.close()
+        if not self.catalog:
+            if self.catalog_marker is None:
+                self.execute(MARKER_QUERY)
+                self.catalog_marker = self.cursor.fetchone()['marker']
+            self.catalog = CatalogCache(self.catalog_cache, self.source)
+            self.catalog.load(self.catalog_marker)
+        return self.catalog
 
+    def query_catalog(self, kind, name, query, params=None, one=False):
+        '''return the rows of a catalog query (or its first row with `one`,
+        empty when there's none), from the catalog cache when it's enabled'''
+        catalog = self.get_catalog()
+        result = catalog.get(kind, name) if catalog else None
+        if result is None:
+            self.execute(query, params)
+            if one:
+                row = self.cursor.fetchone()
+                result = dict(row) if row else {}
+            else:
+                result = [dict(r) for r in self.cursor.fetchall()]
+            if catalog:
+                catalog.set(kind, name, result)
         return result
 
-    def _report_state(self, params, loaded):
-        table_name = '%(__schemaname)s.%(__tablename)s' % params
-        self.state(self.state_id, {table_name: loaded})
+    def save_catalog(self):
+        '''save the catalog cache, failing to do so only slows down the next
+        runs'''
+        if not self.catalog:
+            return
+        try:
+            self.catalog.save()
+        except (IOError, OSError), e:
+            self.log('Failed to save the catalog cache: {}'.format(e))
+
+    def add_checkpoint(self, states, rows):
+        '''add states to the next checkpoint, and report it when it's due'''
+        self.pending_states.update(states)
+        self.pending_rows += rows
+
+        due = True
+        if self.checkpoint_rows or self.checkpoint_seconds:
+            elapsed = time.time() - self.last_checkpoint
+            due = bool(
+                self.checkpoint_rows and
+                self.pending_rows >= self.checkpoint_rows or
+                self.checkpoint_seconds and
+                elapsed >= self.checkpoint_seconds
+            )
+        elif self.checkpoint_tables:
+            due = False
+
+        if due:
+            self.checkpoint()
+
+    def checkpoint(self):
+        '''report the states since the last checkpoint under the state id of
+        all of the rows returned since'''
+        if self.pending_states:
+            self.state(self.state_id, self.pending_states)
+
+        self.pending_states = {}
+        self.pending_rows = 0
+        self.last_checkpoint = time.time()
+
+    def _report_state(self, state, rows=0):
+        table = self.tables[self.index]
+        table_name = get_state_key(table)
 
+        # Keep the latest checkpoint so that when a read is retried after an
+        # error the table is resumed from here rather than from the state the
+        # stream started with
+        self.saved_state[table_name] = state
+        states = {table_name: state}
 
-def connect(source):
+        # ranges report the way the table was split along with their state
+        states.update(get_plan_state(table))
+
+        self.add_checkpoint(states, rows)
+
+
+def connect(source, connection_factory=None,
+            cursor_factory=psycopg2.extras.RealDictCursor):
     '''connect to the DB using properties from the source'''
     host, dbname = source['addr'].rsplit('/', 1)
     port = 5432
@@ -158,6 +1655,16 @@ def connect(source):
         host, port = host.rsplit(':', 1)
         port = int(port)  # pyscopg expects port to be numeric
 
+    # replication connections are created with their own connection class
+    kwargs = {}
+    if connection_factory:
+        kwargs['connection_factory'] = connection_factory
+
+    # arrow ignores the offsets of the timestamps it's given, so the session
+    # returns them in UTC
+    if source.get('__rowFormat') == ROWS_ARROW:
+        kwargs['options'] = '-c timezone=UTC'
+
     try:
         conn = psycopg2.connect(
             host=host,
@@ -165,9 +1672,15 @@ def connect(source):
             user=source['user'],
             password=source['password'],
             dbname=dbname,
-            connect_timeout=CONNECT_TIMEOUT
+            connect_timeout=CONNECT_TIMEOUT,
+            **kwargs
         )
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur = conn.cursor(cursor_factory=cursor_factory)
+
+        # values of some types can be kept as text rather than converted
+        decode = source.get('__decode')
+        if decode and not connection_factory:
+            register_decoders(conn, cur, decode)
     except psycopg2.OperationalError, e:
         if 'authentication failed' in e.message:
             e = panoply.PanoplyException(
@@ -179,17 +1692,167 @@ def connect(source):
     return conn, cur
 
 
-def get_query(schema, table, src, state=None):
-    '''return a SELECT query using properties from the source'''
+def get_query(schema, table, src, state=None, key=None, rng=None,
+              select=None, condition=None):
+    '''return a SELECT query and its parameters using properties from the
+    source. When a key is given the query is ordered by it and continues after
+    the last key saved in the state, with watermarks it's ordered by the
+    incremental key and continues after the saved watermark, otherwise it's
+    resumed with OFFSET. When a range is given only the rows within it are
+    selected. Only the `select` columns (or expressions) are selected when
+    given, and only the rows that match the `condition`'''
+    params = []
+    where = []
+    order = ''
     offset = ''
-    where = ''
-    if src.get('inckey') and src.get('incval'):
-        where = " WHERE {} > '{}'".format(src['inckey'], src['incval'])
 
-    if state:
+    last = state.get('key') if isinstance(state, dict) else None
+
+    # With watermarks the rows are ordered by the incremental key, and the
+    # table continues after its last watermark (or the incremental value on
+    # the first run)
+    inckey = src.get('inckey')
+    since = None
+    if inckey and src.get('__watermark'):
+        since = state.get('watermark') if isinstance(state, dict) else None
+        since = since if since is not None else src.get('incval') or None
+
+    # the parameters are bound by psycopg2, so everything that is formatted
+    # into the query must escape `%` whenever there are parameters
+    bind = last or since is not None
+    esc = (lambda s: s.replace('%', '%%')) if bind else (lambda s: s)
+
+    if inckey and src.get('__watermark'):
+        order = ' ORDER BY {}'.format(esc(inckey))
+        if since is not None:
+            where.append('{} > %s'.format(esc(inckey)))
+            params.append(since)
+    elif inckey and src.get('incval'):
+        where.append(esc("{} > '{}'".format(inckey, src['incval'])))
+
+    if rng:
+        where.extend(get_range_conditions(rng))
+
+    if condition:
+        where.append('({})'.format(esc(condition)))
+
+    if key:
+        columns = esc(', '.join(quote_ident(c) for c in key))
+        order = ' ORDER BY {}'.format(columns)
+        if last:
+            placeholders = ', '.join(['%s'] * len(last))
+            where.append('({}) > ({})'.format(columns, placeholders))
+            params.extend(last)
+    elif state and not isinstance(state, dict):
         offset = " OFFSET %s" % state
 
-    return 'SELECT * FROM "{}"."{}"{}{}'.format(schema, table, where, offset)
+    where = ' WHERE ' + ' AND '.join(where) if where else ''
+    table = esc('"{}"."{}"'.format(schema, table))
+    columns = esc(', '.join(select)) if select else '*'
+    query = 'SELECT {} FROM {}{}{}{}'.format(
+        columns, table, where, order, offset)
+    return query, tuple(params)
+
+
+def get_range_conditions(rng):
+    '''return the conditions that select the rows within a range. The bounds
+    are always integers (page numbers or values of an integer key)'''
+    if rng['column'] == 'ctid':
+        column, bound = 'ctid', "'({:d},0)'::tid"
+    else:
+        column, bound = quote_ident(rng['column']), '{:d}'
+
+    conditions = []
+    if rng['lower'] is not None:
+        conditions.append('{} >= {}'.format(column, bound)
+                          .format(rng['lower']))
+    if rng['upper'] is not None:
+        conditions.append('{} < {}'.format(column, bound)
+                          .format(rng['upper']))
+    return conditions
+
+
+def split_bounds(lower, upper, count):
+    '''split the [lower, upper] interval into `count` ranges. The first and
+    last ranges are unbounded so that rows outside of the interval (added
+    after it was computed) are not missed'''
+    bounds = [lower + (upper - lower + 1) * i // count
+              for i in range(1, count)]
+    bounds = sorted(set(bounds))
+    return zip([None] + bounds, bounds + [None])
+
+
+def split_table(table, ranges):
+    '''return a copy of the table for each of its ranges'''
+    return [
+        dict(table, __range={
+            'id': i,
+            'column': ranges['column'],
+            'lower': lower,
+            'upper': upper,
+            'plan': ranges
+        })
+        for i, (lower, upper) in enumerate(ranges['ranges'])
+    ]
+
+
+def get_plan_state(table):
+    '''return the state of the way a table was split, reported along with
+    the state of each of its ranges'''
+    if '__range' in table:
+        return {table['value']: table['__range']['plan']}
+    return {}
+
+
+def partition_table(table, leaves):
+    '''return a copy of the table for each of its leaf partitions'''
+    return [
+        dict(table, value='{}.{}'.format(leaf['schema'], leaf['name']),
+             __parent=table['value'])
+        for leaf in leaves
+    ]
+
+
+def get_relations(plan):
+    '''yield the (schema, name) of the relations scanned by a query plan (as
+    returned by EXPLAIN (VERBOSE, FORMAT JSON))'''
+    if 'Relation Name' in plan:
+        yield plan['Schema'], plan['Relation Name']
+    for child in plan.get('Plans', []):
+        for relation in get_relations(child):
+            yield relation
+
+
+def get_state_key(table):
+    '''return the key under which the state of the table (or range of the
+    table, or partition of the table) is saved'''
+    rng = table.get('__range')
+    if rng:
+        return '{}#{}'.format(table['value'], rng['id'])
+    if '__parent' in table:
+        return '{}/{}'.format(table['__parent'], table['value'])
+    return table['value']
+
+
+def get_loaded(state):
+    '''return the number of rows already loaded according to the state'''
+    if isinstance(state, dict):
+        return state.get('loaded', 0)
+    return state if state is not None else 0
+
+
+def serialize_key(value):
+    '''convert a key value into something that can be saved in the state and
+    bound back into a query. Postgres casts the text representation of other
+    types (timestamps, numerics, uuids) to the type of the key column'''
+    if value is None or isinstance(value, (int, long, float, basestring)):
+        return value
+    return str(value)
+
+
+def quote_ident(name):
+    '''quote an identifier (column name) for use in a query'''
+    return '"{}"'.format(name.replace('"', '""'))
 
 
 def format_table_name(row):
@@ -204,4 +1867,11 @@ def format_table_name(row):
     if row['table_type'] == 'VIEW':
         name += ' (VIEW)'
 
-    return {'name': name, 'value': value}
+    table = {'name': name, 'value': value}
+
+    # the estimated number of rows and size (bytes) of the table
+    if row.get('rows') is not None:
+        table['rows'] = row['rows']
+        table['bytes'] = row['bytes']
+
+    return table
@@ -17,6 +17,9 @@ setup(
             "pep8==1.7.0",
             "coverage==4.3.4",
             "mock==2.0.0"
+        ],
+        "arrow": [
+            "pyarrow==0.16.0"
         ]
     },
 
@@ -1,8 +1,21 @@
 import mock
+import shutil
+import threading
+import decimal
+import tempfile
+import struct
 import unittest
 import psycopg2
 import postgres
 from postgres.source import Postgres
+from postgres.copystream import unescape
+from postgres.rows import Batch
+from postgres.batching import BatchSizer, MemoryBudget
+from postgres.decoding import get_lazy_caster
+from postgres.replication import ChangeReader, PLUGIN_PGOUTPUT
+from postgres.arrow import pyarrow
+from postgres.hosts import Hosts
+from postgres.catalog import CatalogCache, MARKER_QUERY
 from panoply import PanoplyException
 
 OPTIONS = {
@@ -60,6 +73,85 @@ class TestPostgres(unittest.TestCase):
             self.assertEqual(tables[x]['name'], mtable['name'])
             self.assertEqual(tables[x]['value'], v)
 
+    @mock.patch("psycopg2.connect")
+    def test_catalog_cache(self, mock_connect):
+        '''the list of tables is cached on disk until the catalog changes'''
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.source['__catalogCache'] = directory
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchone.return_value = {'marker': '1/100'}
+        cursor_return_value.fetchall.return_value = [
+            {'table_schema': 'public', 'table_name': 'foo',
+             'table_type': 'BASE TABLE', 'rows': 10, 'bytes': 8192}
+        ]
+
+        tables = Postgres(self.source, OPTIONS).get_tables()
+        self.assertEqual(tables[0]['value'], 'public.foo')
+        self.assertEqual(cursor_return_value.fetchall.call_count, 1)
+
+        # the same marker is served from the cache
+        self.assertEqual(Postgres(self.source, OPTIONS).get_tables(), tables)
+        self.assertEqual(cursor_return_value.fetchall.call_count, 1)
+
+        # and a different one queries the catalog again
+        cursor_return_value.fetchone.return_value = {'marker': '2/200'}
+        Postgres(self.source, OPTIONS).get_tables()
+        self.assertEqual(cursor_return_value.fetchall.call_count, 2)
+
+    @mock.patch("psycopg2.connect")
+    def test_catalog_cache_stale(self, mock_connect):
+        '''cached columns that turn out to be stale are queried again, and
+        dropped from the cache'''
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.source['__catalogCache'] = directory
+        name = '"s"."t"'
+        cache = CatalogCache(directory, self.source).load('1/100')
+        cache.set('columns', name, [{'name': 'a'}, {'name': 'b'}])
+        cache.set('keys', name, {'columns': ['b']})
+        cache.save()
+
+        # the column was renamed without changing the marker
+        columns = [{'name': 'a'}, {'name': 'c'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchone.return_value = {'marker': '1/100'}
+        cursor_return_value.fetchall.return_value = columns
+
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 's.t', 'columns': ['a', 'c']}]
+        inst.read()
+        inst.close()
+
+        cache = CatalogCache(directory, self.source).load('1/100')
+        self.assertEqual(cache.get('columns', name), columns)
+        self.assertEqual(cache.get('keys', name), None)
+
+    @mock.patch("psycopg2.connect")
+    def test_catalog_cache_workers(self, mock_connect):
+        '''the marker of the catalog is queried once per run, the workers
+        load the cache by the marker of the stream'''
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.source['__catalogCache'] = directory
+        self.source['__parallelism'] = 2
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchone.return_value = {'marker': '1/100'}
+
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 's.t'}]
+        inst.plan()
+        workers = [inst._worker(), inst._worker()]
+        for worker in workers:
+            self.assertEqual(worker.get_catalog().marker, '1/100')
+
+        markers = [c for c in cursor_return_value.execute.call_args_list
+                   if c[0][0] == MARKER_QUERY]
+        self.assertEqual(len(markers), 1)
+
     # read a table from the database
     @mock.patch("psycopg2.connect")
     def test_read(self, mock_connect):
@@ -166,6 +258,75 @@ class TestPostgres(unittest.TestCase):
             connect_timeout=postgres.source.CONNECT_TIMEOUT
         )
 
+    def test_hosts(self):
+        '''the least loaded replica is picked, the hosts that failed last'''
+        hosts = Hosts([
+            {'addr': 'p/db', 'role': 'primary'},
+            {'addr': 'r1/db'},
+            {'addr': 'r2/db', 'role': 'replica'}
+        ])
+        self.assertEqual(hosts.pick()['addr'], 'r1/db')
+        self.assertEqual(hosts.pick()['addr'], 'r2/db')
+        self.assertEqual(hosts.pick()['addr'], 'r1/db')
+        self.assertEqual(hosts.load, {'p/db': 0, 'r1/db': 2, 'r2/db': 1})
+
+        hosts.release('r1/db')
+        hosts.release('r1/db')
+        hosts.fail('r1/db')
+        self.assertEqual(hosts.pick()['addr'], 'r2/db')
+        self.assertEqual(hosts.pick(['r2/db'])['addr'], 'p/db')
+        self.assertEqual(hosts.pick(['r2/db', 'p/db'])['addr'], 'r1/db')
+        self.assertEqual(hosts.pick(['r1/db', 'r2/db', 'p/db']), None)
+
+        with self.assertRaises(PanoplyException):
+            Hosts([{'addr': 'x/db', 'role': 'standby'}])
+
+    @mock.patch("psycopg2.connect")
+    def test_replica_failover(self, mock_connect):
+        '''tables are read from the replicas, failing over from the ones
+        that can't be connected to or that lag behind, to the primary'''
+        conn = mock.MagicMock(server_version=160000)
+        conn.cursor.return_value.fetchone.return_value = {'lag': 120}
+        conn.cursor.return_value.fetchall.return_value = self.mock_recs
+
+        def connect(host, port, **kwargs):
+            if host == 'r1':
+                raise psycopg2.OperationalError('could not connect')
+            return conn
+        mock_connect.side_effect = connect
+
+        self.source['__hosts'] = [{'addr': 'r1/foobar', 'role': 'replica'},
+                                  {'addr': 'r2/foobar', 'role': 'replica'}]
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'schema.foo'}]
+        inst.read()
+
+        hosts = [c[1]['host'] for c in mock_connect.call_args_list]
+        self.assertEqual(hosts, ['r1', 'r2', 'test.database.name'])
+        self.assertEqual(inst.host, 'test.database.name/foobar')
+        self.assertEqual(sorted(inst.hosts.failed),
+                         ['r1/foobar', 'r2/foobar'])
+
+        # the host is released once the stream is done with it
+        inst.close()
+        self.assertEqual(inst.hosts.load['test.database.name/foobar'], 0)
+
+    @mock.patch("psycopg2.connect")
+    def test_replica_error(self, mock_connect):
+        '''errors other than failures of the host are raised, and the host
+        isn't left counted as read from'''
+        conn = mock.MagicMock(server_version=160000)
+        conn.cursor.return_value.execute.side_effect = \
+            psycopg2.ProgrammingError('permission denied')
+        mock_connect.return_value = conn
+
+        self.source['__hosts'] = [{'addr': 'r1/foobar', 'role': 'replica'}]
+        inst = Postgres(self.source, OPTIONS)
+        with self.assertRaises(psycopg2.ProgrammingError):
+            inst.connect()
+        self.assertEqual(inst.hosts.load['r1/foobar'], 0)
+        self.assertTrue(conn.close.called)
+
     # Make sure the stream ends properly
     @mock.patch("psycopg2.connect")
     def test_read_end_stream(self, mock_connect):
@@ -186,6 +347,32 @@ class TestPostgres(unittest.TestCase):
         end = inst.read()
         self.assertEqual(end, None)
 
+    @mock.patch("psycopg2.connect")
+    def test_reuse_connection(self, mock_connect):
+        '''the same connection is used for all of the tables, and closed when
+        the stream ends'''
+
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'schema.foo'}, {'value': 'schema.bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.side_effect = [self.mock_recs, [],
+                                                    self.mock_recs, []]
+
+        batch = inst.read()
+        while batch is not None:
+            batch = inst.read()
+
+        self.assertEqual(mock_connect.call_count, 1)
+        declares = [c for c in cursor_return_value.execute.call_args_list
+                    if c[0][0].startswith('DECLARE')]
+        self.assertEqual(len(declares), 2)
+
+        # the transaction is ended after every table, which closes `cur`,
+        # but the connection is only closed once
+        conn = mock_connect.return_value
+        self.assertTrue(conn.rollback.call_count >= len(declares))
+        conn.close.assert_called_once_with()
+
     # Make sure that the state is reported and that the
     # output data contains a key __state
     @mock.patch("postgres.source.Postgres.state")
@@ -252,6 +439,972 @@ class TestPostgres(unittest.TestCase):
         # Three records were returned so the loaded count should be OFFSET + 3
         self.assertEqual(inst.loaded, table_offset + len(self.mock_recs))
 
+    @mock.patch("postgres.source.Postgres.state")
+    @mock.patch("psycopg2.connect")
+    def test_keyset_state(self, mock_connect, mock_state):
+        '''in keyset mode the table is ordered by its key and the last key
+        that was read is reported as the state'''
+
+        self.source['__resumeMode'] = 'keyset'
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchone.return_value = {'columns': ['id']}
+        cursor_return_value.fetchall.return_value = self.mock_recs
+
+        rows = inst.read()
+
+        q = ('DECLARE cur CURSOR FOR SELECT * FROM "my_schema"."foo_bar" '
+             'WHERE inckey > \'incval\' ORDER BY "id"')
+        execute_mock = cursor_return_value.execute
+        execute_mock.assert_has_calls([mock.call(q)], True)
+
+        state = {'columns': ['id'], 'key': [3], 'loaded': 3}
+        mock_state.assert_called_with(rows[0]['__state'],
+                                      {'my_schema.foo_bar': state})
+
+    @mock.patch("postgres.source.Postgres.execute")
+    @mock.patch("psycopg2.connect")
+    def test_recover_from_keyset_state(self, mock_connect, mock_execute):
+        ''' continues to read a table after the last saved key '''
+
+        self.source['state'] = {
+            'my_schema.foo_bar': {
+                'columns': ['id', 'col1'],
+                'key': [1, 'x'],
+                'loaded': 100
+            }
+        }
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.return_value = self.mock_recs
+
+        inst.read()
+        q = ('DECLARE cur CURSOR FOR SELECT * FROM "my_schema"."foo_bar" '
+             'WHERE inckey > \'incval\' AND ("id", "col1") > (%s, %s) '
+             'ORDER BY "id", "col1"')
+        mock_execute.assert_has_calls([mock.call(q, (1, 'x'))])
+        self.assertEqual(inst.loaded, 100 + len(self.mock_recs))
+
+    @mock.patch("postgres.source.Postgres.execute")
+    @mock.patch("psycopg2.connect")
+    def test_keyset_fallback_to_offset(self, mock_connect, mock_execute):
+        ''' tables without a key are resumed with OFFSET '''
+
+        self.source['__resumeMode'] = 'keyset'
+        self.source['state'] = {'my_schema.foo_bar': 100}
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.return_value = self.mock_recs
+
+        inst.read()
+        first_query = mock_execute.call_args_list[0][0][0]
+        self.assertTrue(first_query.endswith('OFFSET 100'))
+
+    @mock.patch("postgres.source.Postgres.state")
+    @mock.patch("psycopg2.connect")
+    def test_retry_resumes_from_last_state(self, mock_connect, mock_state):
+        ''' a read that is retried after an error continues from the last
+        reported state rather than from the beginning of the table '''
+
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.return_value = self.mock_recs
+        inst.read()
+
+        # simulate an error that resets the connection mid table
+        inst.reset()
+        inst.read()
+
+        q = ('DECLARE cur CURSOR FOR SELECT * FROM "my_schema"."foo_bar" '
+             'WHERE inckey > \'incval\' OFFSET 3')
+        execute_mock = cursor_return_value.execute
+        execute_mock.assert_has_calls([mock.call(q)], True)
+
+    @mock.patch("postgres.source.Postgres.read_batch", autospec=True)
+    def test_parallel_read(self, mock_read_batch):
+        '''reads multiple tables concurrently and reports the state of each
+        batch as it's returned'''
+
+        mock_read_batch.side_effect = fake_read_batch(self.mock_recs)
+        self.source['__parallelism'] = 2
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 's.t1'}, {'value': 's.t2'}, {'value': 's.t3'}]
+        states = []
+        inst.on('source-state', lambda state: states.append(state))
+
+        rows = []
+        batch = inst.read()
+        while batch is not None:
+            rows.extend(batch)
+            batch = inst.read()
+
+        tables = sorted(set(r['__tablename'] for r in rows))
+        self.assertEqual(tables, ['t1', 't2', 't3'])
+        self.assertEqual(len(rows), 3 * len(self.mock_recs))
+        self.assertEqual(inst.completed, set(['s.t1', 's.t2', 's.t3']))
+
+        # state is reported by the stream itself once per non-empty batch
+        self.assertEqual(len(states), 3)
+        for state in states:
+            self.assertEqual(state['state'].values(), [len(self.mock_recs)])
+
+    @mock.patch("postgres.source.CONNECT_TIMEOUT", 0)
+    @mock.patch("postgres.source.Postgres.read_batch", autospec=True)
+    def test_parallel_read_retries(self, mock_read_batch):
+        '''an error in one of the workers is raised from read, which is
+        retried with a new pool over the tables that are not done'''
+
+        errors = [psycopg2.DatabaseError('oh noes!')]
+        mock_read_batch.side_effect = fake_read_batch(self.mock_recs, errors)
+        self.source['__parallelism'] = 2
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 's.t1'}, {'value': 's.t2'}]
+
+        rows = []
+        batch = inst.read()
+        while batch is not None:
+            rows.extend(batch)
+            batch = inst.read()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(inst.completed, set(['s.t1', 's.t2']))
+        self.assertEqual(inst.pool, None)
+
+    @mock.patch("postgres.source.Postgres.execute")
+    @mock.patch("psycopg2.connect")
+    def test_split_table(self, mock_connect, mock_execute):
+        '''large tables are split into ranges of their integer key, each
+        read with its own query'''
+
+        self.source['__splitRows'] = 1000
+        self.source['__splitRanges'] = 3
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchone.side_effect = [
+            {'rows': 5000, 'pages': 100, 'kind': 'r', 'version': 90600},
+            {'columns': ['id']},
+            {'type': 'integer'},
+            {'lower': 1, 'upper': 300},
+        ]
+        cursor_return_value.fetchall.return_value = self.mock_recs
+
+        inst.read()
+        ranges = [(None, 101), (101, 201), (201, None)]
+        self.assertEqual(len(inst.tables), len(ranges))
+        for table in inst.tables:
+            self.assertEqual(table['__range']['plan']['ranges'], ranges)
+
+        q = mock_execute.call_args_list[-2][0][0]
+        self.assertTrue(q.endswith('WHERE inckey > \'incval\' AND "id" < 101'))
+
+    @mock.patch("postgres.source.Postgres.execute")
+    @mock.patch("psycopg2.connect")
+    def test_recover_split_table(self, mock_connect, mock_execute):
+        '''a table that was split keeps the same ranges when it's resumed,
+        and each range continues from its own state'''
+
+        ranges = {'column': 'ctid', 'ranges': [[None, 10], [10, None]]}
+        self.source['state'] = {
+            'my_schema.foo_bar': ranges,
+            'my_schema.foo_bar#1': 50
+        }
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.return_value = self.mock_recs
+        inst.index = 1
+
+        inst.read()
+        q = mock_execute.call_args_list[0][0][0]
+        self.assertTrue(q.endswith('ctid >= \'(10,0)\'::tid OFFSET 50'))
+
+    @mock.patch("postgres.source.Postgres.state")
+    @mock.patch("postgres.source.Postgres.execute")
+    @mock.patch("psycopg2.connect")
+    def test_split_table_done(self, mock_connect, mock_execute, mock_state):
+        '''a range that was read to the end is marked as done, and left out
+        when the table is resumed'''
+
+        ranges = {'column': 'ctid', 'ranges': [[None, 10], [10, None]]}
+        self.source['state'] = {
+            'my_schema.foo_bar': ranges,
+            'my_schema.foo_bar#0': {'done': True, 'loaded': 7},
+            'my_schema.foo_bar#1': 50
+        }
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.side_effect = [self.mock_recs, []]
+
+        inst.read()
+        self.assertEqual([t['__range']['id'] for t in inst.tables], [1])
+        q = mock_execute.call_args_list[0][0][0]
+        self.assertTrue(q.endswith('ctid >= \'(10,0)\'::tid OFFSET 50'))
+
+        inst.read()
+        state = mock_state.call_args[0][1]
+        self.assertEqual(state['my_schema.foo_bar#1'],
+                         {'done': True, 'loaded': 53})
+        self.assertEqual(state['my_schema.foo_bar'], ranges)
+
+    @mock.patch("psycopg2.connect")
+    def test_copy(self, mock_connect):
+        '''reads a table with COPY and parses the stream into rows'''
+
+        self.source['__extractMode'] = 'copy'
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.description = [('id', 23), ('col1', 25)]
+
+        def copy_expert(query, f):
+            f.write('1\tfoo1\n2\t\\N\n')
+            f.write('3\tfoo\\t3\n')
+        cursor_return_value.copy_expert.side_effect = copy_expert
+
+        rows = inst.read()
+        copy_query = cursor_return_value.copy_expert.call_args[0][0]
+        self.assertTrue(copy_query.startswith('COPY (SELECT * FROM '))
+        self.assertEqual([(r['id'], r['col1']) for r in rows],
+                         [(1, 'foo1'), (2, None), (3, 'foo\t3')])
+        for row in rows:
+            self.assertEqual(row['__tablename'], 'foo_bar')
+            self.assertEqual(row['__schemaname'], 'my_schema')
+
+        self.assertEqual(inst.read(), [])
+        self.assertEqual(inst.read(), None)
+
+    def test_copy_unescape(self):
+        '''values in the text format of COPY are unescaped'''
+        self.assertEqual(unescape('plain'), 'plain')
+        self.assertEqual(unescape('a\\tb\\nc\\\\d'), 'a\tb\nc\\d')
+        self.assertEqual(unescape('\\101\\x42'), 'AB')
+        self.assertEqual(unescape('\\\\N'), '\\N')
+
+    @mock.patch("psycopg2.connect")
+    def test_compact_rows(self, mock_connect):
+        '''in the compact row format a batch shares its columns and internals
+        between all of its rows, which still behave like dicts'''
+
+        self.source['__rowFormat'] = 'compact'
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.description = [('id',), ('col1',), ('col2',)]
+        cursor_return_value.fetchall.return_value = [
+            (r['id'], r['col1'], r['col2']) for r in self.mock_recs
+        ]
+
+        rows = inst.read()
+        self.assertIsInstance(rows, Batch)
+        self.assertEqual(len(rows), len(self.mock_recs))
+        for row, rec in zip(rows, self.mock_recs):
+            expected = dict(rec, __tablename='foo_bar',
+                            __schemaname='my_schema',
+                            __state=inst.state_id)
+            self.assertEqual(dict(row), expected)
+            self.assertEqual(row, expected)
+            self.assertEqual(row['__tablename'], 'foo_bar')
+            self.assertEqual(row.get('missing'), None)
+
+        # the internals are stored once for the whole batch
+        self.assertEqual(rows.internals['__state'], inst.state_id)
+
+    def test_batch_sizer(self):
+        '''the batch size is adjusted to hit the target bytes and latency per
+        batch, within the bounds'''
+        sizer = BatchSizer(1000, target_bytes=1000000, target_latency=1.0,
+                           min_size=10, max_size=50000)
+
+        # first batch of a table by the estimated row size
+        self.assertEqual(sizer.start(100), 10000)
+        self.assertEqual(sizer.start(), 1000)
+        self.assertEqual(sizer.start(1), 50000)
+
+        # rows of 1000 bytes: 1000 rows per batch
+        self.assertEqual(sizer.update(50000, 50000000, 0.5), 1000)
+        # slow fetches: bounded by latency
+        self.assertEqual(sizer.update(1000, 1000000, 4.0), 250)
+        # grows at most twice as large per batch
+        self.assertEqual(sizer.update(250, 2500, 0.01), 500)
+        # within the min bound
+        self.assertEqual(sizer.update(500, 500000000, 0.01), 10)
+
+    @mock.patch("postgres.source.Postgres.execute")
+    @mock.patch("psycopg2.connect")
+    def test_adaptive_batch_size(self, mock_connect, mock_execute):
+        '''with a target size per batch, the table is fetched in batches sized
+        by the average width of its rows'''
+
+        self.source['__batchBytes'] = 100000
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchone.return_value = {'width': 40,
+                                                     'columns': 1}
+        cursor_return_value.fetchall.return_value = self.mock_recs
+
+        inst.read()
+        fetch = mock_execute.call_args_list[-1][0][0]
+        self.assertEqual(fetch, 'FETCH FORWARD 250 FROM cur')
+
+    def test_memory_budget(self):
+        '''reservations wait until the budget is released, unless nothing
+        is held at all'''
+        budget = MemoryBudget(100)
+        budget.acquire(150)  # larger than the budget, but nothing is held
+        budget.adjust(150, 60)
+        self.assertEqual(budget.used, 60)
+
+        acquired = threading.Event()
+
+        def acquire():
+            budget.acquire(60)
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+
+        budget.release(60)
+        thread.join(1)
+        self.assertTrue(acquired.is_set())
+        self.assertEqual(budget.used, 60)
+
+        # closing the budget stops blocking
+        budget.close()
+        budget.acquire(100)
+        self.assertEqual(budget.used, 60)
+
+    @mock.patch("postgres.source.Postgres.execute")
+    @mock.patch("psycopg2.connect")
+    def test_memory_budget_fetch(self, mock_connect, mock_execute):
+        '''with a memory budget, FETCHes are shrunk to fit in the budget and
+        the size of a batch is held until the next read'''
+
+        self.source['__memoryBudget'] = 100000
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchone.return_value = {'width': 40,
+                                                     'columns': 1}
+        cursor_return_value.fetchall.return_value = self.mock_recs
+
+        inst.read()
+        fetch = mock_execute.call_args_list[-1][0][0]
+        self.assertEqual(fetch, 'FETCH FORWARD 250 FROM cur')
+        self.assertTrue(inst.held > 0)
+        self.assertEqual(inst.budget.used, inst.held)
+
+        # the next FETCH is sized by the measured rows
+        row_size = inst.held // len(self.mock_recs)
+        cursor_return_value.fetchall.return_value = []
+        inst.read()
+        fetch = mock_execute.call_args_list[-1][0][0]
+        self.assertEqual(fetch, 'FETCH FORWARD {} FROM cur'
+                         .format(100000 // row_size))
+        self.assertEqual(inst.budget.used, 0)
+
+    @mock.patch("postgres.source.CONNECT_TIMEOUT", 0)
+    @mock.patch("postgres.source.Postgres.fetch")
+    @mock.patch("psycopg2.connect")
+    def test_memory_budget_retry(self, mock_connect, mock_fetch):
+        '''the reservation of a batch that failed to be fetched is released,
+        so that the retry doesn't wait for it forever'''
+
+        self.source['__memoryBudget'] = 100000
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+
+        # rows of 400 bytes, the first batch reserves the whole budget
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchone.return_value = {'width': 40,
+                                                     'columns': 1}
+        mock_fetch.side_effect = [psycopg2.OperationalError('oh noes!'),
+                                  self.mock_recs]
+
+        rows = inst.read()
+        self.assertEqual(len(rows), len(self.mock_recs))
+        self.assertEqual(mock_fetch.call_count, 2)
+        self.assertEqual(inst.budget.used, inst.held)
+
+    @mock.patch("postgres.source.Postgres.execute")
+    @mock.patch("psycopg2.connect")
+    def test_memory_budget_lazy(self, mock_connect, mock_execute):
+        '''rows iterated one by one are kept within the memory budget as
+        well: the FETCH is reserved and released once its rows were yielded,
+        and the next one is sized by the measured rows'''
+
+        self.source['__memoryBudget'] = 100000
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchone.return_value = {'width': 40,
+                                                     'columns': 1}
+        cursor_return_value.__iter__.side_effect = [
+            iter(self.mock_recs), iter([])
+        ]
+
+        rows = inst.iter_rows()
+        next(rows)
+        fetch = mock_execute.call_args_list[-1][0][0]
+        self.assertEqual(fetch, 'FETCH FORWARD 250 FROM cur')
+        self.assertTrue(inst.budget.used > 0)
+
+        self.assertEqual(len(list(rows)), len(self.mock_recs) - 1)
+        fetches = [c[0][0] for c in mock_execute.call_args_list
+                   if c[0][0].startswith('FETCH')]
+        self.assertEqual(fetches[-1], 'FETCH FORWARD {} FROM cur'
+                         .format(100000 // inst.row_size))
+        self.assertEqual(inst.budget.used, 0)
+
+    @mock.patch("postgres.source.Postgres.read_batch", autospec=True)
+    def test_prefetch(self, mock_read_batch):
+        '''with prefetching the tables are read one at a time by a background
+        worker, which keeps the next batches ready'''
+
+        mock_read_batch.side_effect = fake_read_batch(self.mock_recs)
+        self.source['__prefetch'] = 2
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 's.t1'}, {'value': 's.t2'}]
+
+        batch = inst.read()
+        self.assertEqual(inst.pool.results.maxsize, 2)
+        self.assertEqual(len(inst.pool.threads), 1)
+
+        tables = []
+        while batch is not None:
+            tables.extend(r['__tablename'] for r in batch)
+            batch = inst.read()
+
+        # the tables are still read in order
+        self.assertEqual(tables, ['t1'] * 3 + ['t2'] * 3)
+
+    @mock.patch("psycopg2.connect")
+    def test_columns_and_filter(self, mock_connect):
+        '''selects only the included columns (and truncates large values)
+        from the rows that match the filter of the table'''
+
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar',
+                        'exclude': ['col2'],
+                        'truncate': 100,
+                        'where': "col1 LIKE 'foo%'"}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.side_effect = [
+            [{'name': 'id', 'type': 'integer'},
+             {'name': 'col1', 'type': 'text'},
+             {'name': 'col2', 'type': 'bytea'}],
+            []
+        ]
+
+        inst.read()
+        q = ('DECLARE cur CURSOR FOR SELECT "id", left("col1"::text, 100) '
+             'AS "col1" FROM "my_schema"."foo_bar" '
+             'WHERE inckey > \'incval\' AND (col1 LIKE \'foo%\')')
+        execute_mock = cursor_return_value.execute
+        execute_mock.assert_has_calls([mock.call(q)], True)
+
+    @mock.patch("psycopg2.connect")
+    def test_unknown_columns(self, mock_connect):
+        ''' fails without retrying when a column doesn't exist '''
+
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar', 'columns': ['nope']}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.return_value = [
+            {'name': 'id', 'type': 'integer'}
+        ]
+
+        with self.assertRaises(PanoplyException):
+            inst.read()
+        self.assertEqual(mock_connect.call_count, 1)
+
+    @mock.patch("postgres.source.Postgres.state")
+    @mock.patch("psycopg2.connect")
+    def test_checkpoint_rows(self, mock_connect, mock_state):
+        '''batches share the same state id until the state is reported every
+        N rows, and at the end of the table'''
+
+        self.source['__checkpointRows'] = 5
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.side_effect = [
+            self.mock_recs, self.mock_recs, self.mock_recs, []
+        ]
+
+        first = inst.read()
+        self.assertFalse(mock_state.called)
+
+        second = inst.read()
+        self.assertEqual(first[0]['__state'], second[0]['__state'])
+        mock_state.assert_called_once_with(second[0]['__state'],
+                                           {'my_schema.foo_bar': 6})
+
+        # the end of the table reports the rows since the last checkpoint
+        third = inst.read()
+        self.assertNotEqual(third[0]['__state'], second[0]['__state'])
+        self.assertEqual(mock_state.call_count, 1)
+        inst.read()
+        mock_state.assert_called_with(third[0]['__state'],
+                                      {'my_schema.foo_bar': 9})
+
+    @mock.patch("postgres.source.Postgres.state")
+    @mock.patch("psycopg2.connect")
+    def test_partitions(self, mock_connect, mock_state):
+        '''partitioned tables are read partition by partition, tagged with
+        the partitioned table, and partitions without matching rows (by the
+        plan of the query of the whole table) are skipped'''
+
+        self.source['__partitions'] = True
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.events'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.side_effect = [
+            [{'schema': 'my_schema', 'name': 'events_1', 'rows': 0,
+              'bytes': 0},
+             {'schema': 'my_schema', 'name': 'events_2', 'rows': 0,
+              'bytes': 0}],
+            self.mock_recs, []
+        ]
+        cursor_return_value.fetchone.return_value = {'QUERY PLAN': [{
+            'Plan': {'Node Type': 'Append', 'Plans': [
+                {'Schema': 'my_schema', 'Relation Name': 'events_2'}
+            ]}
+        }]}
+
+        rows = inst.read()
+        self.assertEqual(rows[0]['__tablename'], 'events')
+        mock_state.assert_called_with(rows[0]['__state'], {
+            'my_schema.events/my_schema.events_2': 3
+        })
+
+        q = ('DECLARE cur CURSOR FOR SELECT * FROM "my_schema"."events_2" '
+             'WHERE inckey > \'incval\'')
+        execute_mock = cursor_return_value.execute
+        execute_mock.assert_has_calls([mock.call(q)], True)
+
+        inst.read()
+        self.assertEqual(inst.read(), None)
+
+    @mock.patch("postgres.source.Postgres.state")
+    @mock.patch("psycopg2.connect")
+    def test_skip_unchanged(self, mock_connect, mock_state):
+        '''tables that were not modified since they were last read are
+        skipped, and the tables that were modified are read again from the
+        start, by the state of the previous run'''
+
+        self.source['__skipUnchanged'] = True
+        tables = [{'value': 'my_schema.foo'}, {'value': 'my_schema.bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        execute_mock = cursor_return_value.execute
+        states = {}
+        mock_state.side_effect = lambda _, state: states.update(state)
+
+        def run(foo, bar):
+            cursor_return_value.fetchall.side_effect = [
+                [{'name': 'my_schema.foo', 'kind': 'r', 'changes': foo,
+                  'recovery': False},
+                 {'name': 'my_schema.bar', 'kind': 'r', 'changes': bar,
+                  'recovery': False}],
+                self.mock_recs, [], self.mock_recs, []
+            ]
+            execute_mock.reset_mock()
+            inst = Postgres(dict(self.source, state=dict(states)), OPTIONS)
+            inst.tables = tables
+            names = []
+            batch = inst.read()
+            while batch is not None:
+                names.extend(r['__tablename'] for r in batch)
+                batch = inst.read()
+            declares = [c[0][0] for c in execute_mock.call_args_list
+                        if c[0][0].startswith('DECLARE')]
+            return inst, names, declares
+
+        inst, names, _ = run('3/0/0/100', '3/0/0/200')
+        self.assertEqual(names, ['foo'] * 3 + ['bar'] * 3)
+        self.assertEqual(states, {
+            '__changes': {'my_schema.foo': '3/0/0/100',
+                          'my_schema.bar': '3/0/0/200'},
+            'my_schema.foo': None,
+            'my_schema.bar': None
+        })
+
+        # only bar was modified, it's read from the start
+        inst, names, declares = run('3/0/0/100', '4/0/0/200')
+        self.assertEqual(inst.skipped, ['my_schema.foo'])
+        self.assertEqual(names, ['bar'] * 3)
+        self.assertEqual(len(declares), 1)
+        self.assertNotIn('OFFSET', declares[0])
+        self.assertEqual(states['__changes']['my_schema.bar'], '4/0/0/200')
+
+    @mock.patch("postgres.source.Postgres.state")
+    @mock.patch("psycopg2.connect")
+    def test_iter_rows(self, mock_connect, mock_state):
+        '''yields the rows straight off the cursor, and reports the state of
+        every batch once all of its rows were yielded'''
+
+        self.source['__batchSize'] = 3
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.__iter__.side_effect = [
+            iter(self.mock_recs), iter(self.mock_recs[:1]), iter([])
+        ]
+
+        rows = inst.iter_rows()
+        for i in range(3):
+            row = next(rows)
+            self.assertEqual(row['id'], i + 1)
+            self.assertEqual(row['__tablename'], 'foo_bar')
+        self.assertFalse(mock_state.called)
+
+        next(rows)
+        mock_state.assert_called_once_with(row['__state'],
+                                           {'my_schema.foo_bar': 3})
+        self.assertEqual(list(rows), [])
+        self.assertEqual(mock_state.call_args[0][1], {'my_schema.foo_bar': 4})
+        self.assertFalse(cursor_return_value.fetchall.called)
+
+    @mock.patch("psycopg2.connect")
+    def test_iter_batches(self, mock_connect):
+        ''' yields the batches without the empty ones of the ends of tables '''
+
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'},
+                       {'value': 'my_schema.bar_baz'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.side_effect = [
+            self.mock_recs, [], self.mock_recs[:1], []
+        ]
+
+        batches = list(inst.iter_batches())
+        self.assertEqual([len(b) for b in batches], [3, 1])
+        self.assertEqual(batches[1][0]['__tablename'], 'bar_baz')
+
+    @mock.patch("postgres.source.Postgres.state")
+    @mock.patch("psycopg2.connect")
+    def test_watermark(self, mock_connect, mock_state):
+        '''with watermarks the table is ordered by the incremental key and
+        the highest value that was completely read is reported as the state'''
+
+        self.source['__watermark'] = True
+        self.source['__batchSize'] = 3
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.side_effect = [
+            [{'id': 1, 'inckey': 10}, {'id': 2, 'inckey': 11},
+             {'id': 3, 'inckey': 11}],
+            [{'id': 4, 'inckey': 11}, {'id': 5, 'inckey': 12}],
+        ]
+
+        rows = inst.read()
+        q = ('DECLARE cur CURSOR FOR SELECT * FROM "my_schema"."foo_bar" '
+             'WHERE inckey > %s ORDER BY inckey')
+        execute_mock = cursor_return_value.execute
+        execute_mock.assert_has_calls([mock.call(q, ('incval',))], True)
+
+        # more rows with the last value might follow
+        state = {'my_schema.foo_bar': {'watermark': 10}}
+        mock_state.assert_called_with(rows[0]['__state'], state)
+
+        # the last batch of the table
+        rows = inst.read()
+        state = {'my_schema.foo_bar': {'watermark': 12}}
+        mock_state.assert_called_with(rows[0]['__state'], state)
+
+    @mock.patch("postgres.source.Postgres.state")
+    @mock.patch("psycopg2.connect")
+    def test_watermark_nulls(self, mock_connect, mock_state):
+        '''rows with a NULL incremental key (sorted last) don't reset the
+        watermark'''
+
+        self.source['__watermark'] = True
+        self.source['__batchSize'] = 3
+        del self.source['incval']
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.side_effect = [
+            [{'id': 1, 'inckey': 10}, {'id': 2, 'inckey': 11},
+             {'id': 3, 'inckey': None}],
+            [{'id': 4, 'inckey': None}],
+        ]
+
+        # the rows with the last value were all read before the NULLs
+        rows = inst.read()
+        state = {'my_schema.foo_bar': {'watermark': 11}}
+        mock_state.assert_called_with(rows[0]['__state'], state)
+
+        rows = inst.read()
+        mock_state.assert_called_with(rows[0]['__state'], state)
+
+    @mock.patch("psycopg2.connect")
+    def test_recover_from_watermark(self, mock_connect):
+        ''' continues to read a table after its saved watermark '''
+
+        self.source['__watermark'] = True
+        self.source['state'] = {'my_schema.foo_bar': {'watermark': 42}}
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.return_value = []
+
+        inst.read()
+        q = ('DECLARE cur CURSOR FOR SELECT * FROM "my_schema"."foo_bar" '
+             'WHERE inckey > %s ORDER BY inckey')
+        execute_mock = cursor_return_value.execute
+        execute_mock.assert_has_calls([mock.call(q, (42,))], True)
+
+    @mock.patch("psycopg2.extensions.register_type")
+    @mock.patch("psycopg2.connect")
+    def test_decode(self, mock_connect, mock_register_type):
+        '''registers typecasters on the connection for the types that are
+        not converted into python objects'''
+
+        self.source['__decode'] = {'numeric': 'raw', 'jsonb': 'lazy'}
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.return_value = [
+            {'name': 'numeric', 'oid': 1700}, {'name': 'jsonb', 'oid': 3802}
+        ]
+        postgres.source.connect(self.source)
+
+        self.assertEqual(mock_register_type.call_count, 2)
+        for call in mock_register_type.call_args_list:
+            self.assertEqual(call[0][1], mock_connect.return_value)
+
+        # unknown types fail without retrying
+        cursor_return_value.fetchall.return_value = [
+            {'name': 'nosuchtype', 'oid': None}
+        ]
+        with self.assertRaises(PanoplyException):
+            postgres.source.connect(self.source)
+
+    def test_lazy_decode(self):
+        ''' lazy values are the text of the value until they're decoded '''
+
+        caster = get_lazy_caster(mock.Mock(), 'numeric', 1700)
+        value = caster('1.50', None)
+        self.assertEqual(value, '1.50')
+        self.assertEqual(value.value, decimal.Decimal('1.50'))
+        self.assertEqual(caster(None, None), None)
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    @mock.patch("psycopg2.extensions.register_type")
+    @mock.patch("psycopg2.connect")
+    def test_arrow(self, mock_connect, mock_register_type):
+        '''returns record batches with the schema of the table, and the
+        internals in their metadata'''
+
+        self.source['__rowFormat'] = 'arrow'
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.description = [
+            ('id', 20, None, 8, None, None, None),
+            ('amount', 1700, None, 8, 12, 2, None),
+            ('doc', 3802, None, -1, None, None, None),
+        ]
+        cursor_return_value.fetchall.side_effect = [
+            [(1, decimal.Decimal('1.50'), '{"a": 1}'), (2, None, None)], []
+        ]
+
+        batch = inst.read()
+        self.assertEqual(batch.num_rows, 2)
+        self.assertEqual(batch.schema.types, [
+            pyarrow.int64(), pyarrow.decimal128(12, 2), pyarrow.string()
+        ])
+        self.assertEqual(batch.column(0).to_pylist(), [1, 2])
+        self.assertEqual(batch.column(2).to_pylist(), ['{"a": 1}', None])
+        self.assertEqual(batch.schema.metadata['__tablename'], 'foo_bar')
+
+        # jsonb is kept as the text sent by the server
+        typ = mock_register_type.call_args[0][0]
+        self.assertEqual(typ.values, (3802,))
+
+        # sessions return timestamps in UTC
+        kwargs = mock_connect.call_args[1]
+        self.assertEqual(kwargs['options'], '-c timezone=UTC')
+
+    @mock.patch("postgres.arrow.pyarrow", None)
+    @mock.patch("psycopg2.connect")
+    def test_arrow_missing(self, mock_connect):
+        ''' the arrow row format fails without retrying without pyarrow '''
+
+        self.source['__rowFormat'] = 'arrow'
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        with self.assertRaises(PanoplyException):
+            inst.read()
+
+    @mock.patch("psycopg2.connect")
+    def test_metrics(self, mock_connect):
+        '''passes the timing spans and counters of every batch to the metrics
+        callback, and a summary at the end of every table'''
+
+        events = []
+        inst = Postgres(self.source, dict(OPTIONS, metrics=events.append))
+        inst.tables = [{'value': 'my_schema.foo_bar'}]
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.side_effect = [self.mock_recs, []]
+
+        inst.read()
+        spans = [e['name'] for e in events if e['type'] == 'span']
+        self.assertEqual(spans, ['connect', 'declare', 'fetch', 'typecast',
+                                 'rows', 'state'])
+        counters = dict((e['name'], e['value']) for e in events
+                        if e['type'] == 'counter')
+        self.assertEqual(counters['rows'], 3)
+        self.assertTrue(counters['bytes'] > 0)
+        self.assertTrue(all(e['table'] == 'my_schema.foo_bar'
+                            for e in events))
+
+        inst.read()
+        summary = events[-1]
+        self.assertEqual(summary['type'], 'summary')
+        self.assertEqual(summary['batches'], 2)
+        self.assertEqual(summary['counters']['rows'], 3)
+        self.assertEqual(sorted(summary['spans']), [
+            'connect', 'declare', 'fetch', 'rows', 'state', 'typecast'
+        ])
+
+    @mock.patch("psycopg2.connect")
+    def test_schedule_by_size(self, mock_connect):
+        '''reads the largest tables first and reports the progress in
+        estimated rows'''
+
+        self.source['__schedule'] = 'size'
+        inst = Postgres(self.source, OPTIONS)
+        inst.tables = [{'value': 'my_schema.small'},
+                       {'value': 'my_schema.large'}]
+        progress = []
+        inst.on('progress', lambda p: progress.append(p))
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchall.side_effect = [
+            [{'name': 'my_schema.small', 'rows': 10, 'bytes': 8192},
+             {'name': 'my_schema.large', 'rows': 90, 'bytes': 81920}],
+            self.mock_recs
+        ]
+
+        rows = inst.read()
+        self.assertEqual(rows[0]['__tablename'], 'large')
+        self.assertEqual(progress[-1]['loaded'], 3)
+        self.assertEqual(progress[-1]['total'], 100)
+        self.assertIn('Read 3 out of ~100 rows', progress[-1]['msg'])
+
+    @mock.patch("postgres.source.Postgres.state")
+    @mock.patch("psycopg2.connect")
+    def test_cdc(self, mock_connect, mock_state):
+        '''reads the changes from the replication slot and reports the LSN
+        of the last transaction that was read as the state'''
+
+        self.source['__cdc'] = True
+        self.source['__idleTimeout'] = 0
+        self.source['state'] = {'__lsn': '0/10'}
+        self.source['tables'] = [{'value': 'my_schema.foo_bar'}]
+        inst = Postgres(self.source, OPTIONS)
+        cursor_return_value = mock_connect.return_value.cursor.return_value
+        cursor_return_value.fetchone.return_value = {
+            'lsn': '0/FF', 'plugin': 'test_decoding'
+        }
+        cursor_return_value.fetchall.return_value = [
+            {'name': 'integer', 'oid': 23}, {'name': 'text', 'oid': 25}
+        ]
+        messages = [
+            ('BEGIN', 0x20),
+            ("table my_schema.foo_bar: INSERT: id[integer]:1 "
+             "col1[text]:'it''s' col2[text]:null", 0x21),
+            ("table my_schema.other: INSERT: id[integer]:1", 0x22),
+            ('table my_schema.foo_bar: DELETE: id[integer]:2', 0x23),
+            ('COMMIT', 0x30),
+        ]
+        cursor_return_value.read_message.side_effect = [
+            mock.Mock(payload=payload, data_start=lsn)
+            for payload, lsn in messages
+        ] + [None]
+
+        rows = inst.read()
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['__op'], 'insert')
+        self.assertEqual(rows[0]['id'], 1)
+        self.assertEqual(rows[0]['col1'], "it's")
+        self.assertEqual(rows[0]['col2'], None)
+        self.assertEqual(rows[0]['__tablename'], 'foo_bar')
+        self.assertEqual(rows[0]['__lsn'], '0/21')
+        self.assertEqual(rows[1]['__op'], 'delete')
+        self.assertEqual(rows[1]['id'], 2)
+
+        # continues after the saved LSN, and advances the slot to it
+        cursor_return_value.start_replication.assert_called_with(
+            slot_name='panoply', start_lsn=0x10, options=mock.ANY
+        )
+        cursor_return_value.send_feedback.assert_called_with(flush_lsn=0x10)
+        mock_state.assert_called_with(rows[0]['__state'], {'__lsn': '0/30'})
+
+        # caught up
+        self.assertEqual(inst.read(), None)
+
+        # a retry continues after the LSN that was read, but the slot is only
+        # advanced to the LSN that the stream was started with
+        inst.start_changes()
+        cursor_return_value.start_replication.assert_called_with(
+            slot_name='panoply', start_lsn=0x30, options=mock.ANY
+        )
+        self.assertEqual(cursor_return_value.send_feedback.call_args_list,
+                         [mock.call(flush_lsn=0x10)] * 2)
+
+    def test_test_decoding_truncate(self):
+        '''a truncate of several tables is a change of each of them'''
+
+        reader = ChangeReader(None, None, 'slot')
+        changes = reader.parse_test_decoding(
+            'table public.a, "my schema"."b, c", "my schema".b: '
+            'TRUNCATE: (no-flags)'
+        )
+        self.assertEqual(changes, [
+            ('public', 'a', 'truncate', {}),
+            ('my schema', 'b, c', 'truncate', {}),
+            ('my schema', 'b', 'truncate', {})
+        ])
+
+    def test_pgoutput(self):
+        ''' parses the messages of the pgoutput protocol '''
+
+        reader = ChangeReader(None, None, 'slot', PLUGIN_PGOUTPUT)
+
+        def tuple_data(*values):
+            data = struct.pack('!h', len(values))
+            for v in values:
+                if v is None:
+                    data += 'n'
+                else:
+                    data += 't' + struct.pack('!i', len(v)) + v
+            return data
+
+        relation = ('R' + struct.pack('!i', 7) + 'my_schema\0foo_bar\0' +
+                    struct.pack('!bh', 100, 2) +
+                    '\1id\0' + struct.pack('!ii', 23, -1) +
+                    '\0col1\0' + struct.pack('!ii', 25, -1))
+        self.assertEqual(reader.parse_pgoutput(relation), [])
+
+        insert = 'I' + struct.pack('!i', 7) + 'N' + tuple_data('1', 'foo')
+        self.assertEqual(reader.parse_pgoutput(insert), [
+            ('my_schema', 'foo_bar', 'insert', {'id': 1, 'col1': 'foo'})
+        ])
+
+        # only the key of deleted rows is sent, other columns are left out
+        delete = 'D' + struct.pack('!i', 7) + 'K' + tuple_data('2', None)
+        self.assertEqual(reader.parse_pgoutput(delete), [
+            ('my_schema', 'foo_bar', 'delete', {'id': 2})
+        ])
+
     def test_remove_state_from_source(self):
         ''' once extracted, the state object is removed from the source '''
 
@@ -305,5 +1458,31 @@ class TestPostgres(unittest.TestCase):
         self.assertEqual(mock_connect.call_count, postgres.source.MAX_RETRIES)
 
 
+def fake_read_batch(recs, errors=None):
+    '''returns a replacement for `Postgres.read_batch` that reads a single
+    batch from each table, raising the given errors first'''
+    def read_batch(stream, batch_size):
+        if errors:
+            raise errors.pop()
+
+        if stream.index >= len(stream.tables):
+            return None
+
+        schema, table = stream.tables[stream.index]['value'].split('.', 1)
+        if stream.loaded:
+            stream.index += 1
+            stream.loaded = 0
+            return []
+
+        stream.state_id = str(stream.index)
+        internals = dict(__tablename=table, __schemaname=schema,
+                         __state=stream.state_id)
+        stream.loaded = len(recs)
+        stream._report_state(stream.loaded)
+        return [dict(r, **internals) for r in recs]
+
+    return read_batch
+
+
 if __name__ == "__main__":
     unittest.main()